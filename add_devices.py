@@ -22,15 +22,11 @@ devices_list = ["canal-cleaner", "weather-station"]
 
 
 def main():
-    # Create devices
-    print("Creating devices...")
-    for device_id in devices_list:
-        manager.create_device(service_account_json, project_id, cloud_region, registry_id, device_id)
-    # Bind created device to gateway
-    print("Binding devices to Gateway...")
-    for device_id in devices_list:
-        manager.bind_device_to_gateway(service_account_json, project_id, cloud_region, registry_id, device_id,
-                                       gateway_id)
+    # Create the devices and bind them to the gateway
+    print("Provisioning devices...")
+    results = manager.bulk_provision(service_account_json, project_id, cloud_region, registry_id,
+                                     [(device_id, gateway_id) for device_id in devices_list])
+    manager.print_provision_report(results)
 
 
 if __name__ == '__main__':
@@ -1,9 +1,141 @@
 import base64
 import json
+import struct
 from google.cloud import bigquery
 from twilio.rest import Client
 
 
+CBOR_SELF_DESCRIBE = b'\xd9\xd9\xf7'
+
+# Protobuf field number -> reading field, by subfolder (see telemetry.proto
+# in the gateway). Both timestamp fields map to "timestamp".
+PROTOBUF_FIELDS = {
+    "canal_cleaner": {1: "device_id", 2: "obstruction", 3: "timestamp", 4: "timestamp"},
+    "weather_station": {1: "device_id", 2: "humidity", 3: "temperature", 4: "water_level",
+                        5: "timestamp", 6: "timestamp"},
+}
+
+
+def get_readings(data):
+    """The gateway publishes either a single reading or a batch (JSON array)
+    of readings. Always return a list of readings."""
+    if isinstance(data, list):
+        return data
+    return [data]
+
+
+def read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def decode_protobuf_reading(data, names):
+    reading = {}
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        number, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+            if value >= 1 << 63:
+                value -= 1 << 64
+        elif wire_type == 1:
+            value, = struct.unpack_from('<d', data, pos)
+            pos += 8
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            value = data[pos:pos + length].decode('utf-8')
+            pos += length
+        elif wire_type == 5:
+            value, = struct.unpack_from('<f', data, pos)
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+        if number in names:
+            reading[names[number]] = value
+    return reading
+
+
+def decode_protobuf(data, subfolder):
+    """Decode a <Sensor>Readings message."""
+    names = PROTOBUF_FIELDS[subfolder]
+    readings = []
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        length, pos = read_varint(data, pos)
+        if key == 0x0a:
+            readings.append(decode_protobuf_reading(data[pos:pos + length], names))
+        pos += length
+    return readings
+
+
+def decode_cbor(data, pos=0):
+    """Decode the CBOR item at pos. Returns (value, position after it)."""
+    initial = data[pos]
+    pos += 1
+    major, info = initial >> 5, initial & 0x1f
+    if major == 7:
+        if info == 27:
+            return struct.unpack_from('>d', data, pos)[0], pos + 8
+        if info == 26:
+            return struct.unpack_from('>f', data, pos)[0], pos + 4
+        return {20: False, 21: True, 22: None}[info], pos
+    if info < 24:
+        value = info
+    else:
+        size = 1 << (info - 24)
+        value = int.from_bytes(data[pos:pos + size], 'big')
+        pos += size
+    if major == 0:
+        return value, pos
+    if major == 1:
+        return -1 - value, pos
+    if major == 2:
+        return bytes(data[pos:pos + value]), pos + value
+    if major == 3:
+        return data[pos:pos + value].decode('utf-8'), pos + value
+    if major == 4:
+        items = []
+        for _ in range(value):
+            item, pos = decode_cbor(data, pos)
+            items.append(item)
+        return items, pos
+    if major == 5:
+        items = {}
+        for _ in range(value):
+            key, pos = decode_cbor(data, pos)
+            items[key], pos = decode_cbor(data, pos)
+        return items, pos
+    # Tag, such as the self-describe tag: the tagged item follows.
+    return decode_cbor(data, pos)
+
+
+def decode_payload(data, attributes):
+    """Decode the readings of a message in any of the gateway encodings.
+    MQTT 3.1.1 cannot carry message attributes, so unless an "encoding"
+    attribute is set the encoding is recognized from the payload itself."""
+    encoding = attributes.get("encoding")
+    if encoding is None:
+        if data.startswith(CBOR_SELF_DESCRIBE):
+            encoding = "cbor"
+        elif data[:1] in (b'{', b'['):
+            encoding = "json"
+        else:
+            encoding = "protobuf"
+    if encoding == "cbor":
+        return get_readings(decode_cbor(data)[0])
+    if encoding == "protobuf":
+        return decode_protobuf(data, attributes.get("subFolder", "canal_cleaner"))
+    return get_readings(json.loads(data.decode('utf-8')))
+
+
 def predict(event, context):
     """Triggered from a message on a Cloud Pub/Sub topic.
     Args:
@@ -18,13 +150,13 @@ def predict(event, context):
         print(f"Error! Invalid registry ID format : '{registry_id}'")
 
     # Get canal obstruction info
-    message = base64.b64decode(event['data']).decode('utf-8')
-    print(f"Receiving sensor data (canal obstruction) : {message}")
-    data = json.loads(message)
-    canal_obstruction = data["obstruction"]
+    readings = decode_payload(base64.b64decode(event['data']), event['attributes'])
+    print(f"Receiving sensor data (canal obstruction) : {readings}")
+    # A batch raises the alert if the canal was obstructed at any time in it
+    canal_obstruction = max(int(reading["obstruction"]) for reading in readings)
     print(f"Canal obstruction : {canal_obstruction}")
 
-    if int(canal_obstruction) == 0:
+    if canal_obstruction == 0:
         return
 
     # Prediction based on the last 12 hours recorded sensors data (temperature, humidity, month)
@@ -0,0 +1,323 @@
+"""
+Local stand-in for the Cloud IoT Core MQTT bridge, to run the gateway
+offline.
+
+Speaks the subset of MQTT 3.1.1 the gateway uses (CONNECT, PUBLISH at QoS 0
+and 1, SUBSCRIBE, UNSUBSCRIBE, PINGREQ, DISCONNECT) over TLS, and checks the
+JWT the gateway sends as password like the bridge does: signature, audience
+and expiry. Every PUBLISH is passed to a callback, and acknowledged right
+away or after puback_delay seconds; a second callback runs once the PUBACK
+is written out. publish() sends config and commands
+messages to the subscribed clients at QoS 0.
+
+Usage example, with the gateway configured for localhost:8883:
+
+    python fake_broker.py --port 8883 --public-key rsa_cert.pem --audience my-project
+"""
+
+import argparse
+import asyncio
+import collections
+import datetime
+import ipaddress
+import os
+import ssl
+import struct
+import time
+
+import jwt
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+CONNACK_ACCEPTED = 0
+CONNACK_REFUSED_BAD_CREDENTIALS = 4
+CONNACK_REFUSED_NOT_AUTHORIZED = 5
+
+
+def write_tls_files(directory, hostname='localhost'):
+    """Writes a CA (roots.pem, as the gateway expects it) and a server
+    certificate signed by it for hostname and 127.0.0.1. Returns the paths
+    of the CA, the server certificate and its key."""
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    ca_key = ec.generate_private_key(ec.SECP256R1())
+    ca_name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'fake broker CA')])
+    ca_cert = (x509.CertificateBuilder()
+               .subject_name(ca_name).issuer_name(ca_name)
+               .public_key(ca_key.public_key())
+               .serial_number(x509.random_serial_number())
+               .not_valid_before(now - datetime.timedelta(minutes=5))
+               .not_valid_after(now + datetime.timedelta(days=1))
+               .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+               .sign(ca_key, hashes.SHA256()))
+    key = ec.generate_private_key(ec.SECP256R1())
+    cert = (x509.CertificateBuilder()
+            .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hostname)]))
+            .issuer_name(ca_name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(minutes=5))
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .add_extension(x509.SubjectAlternativeName([
+                x509.DNSName(hostname), x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]), critical=False)
+            .sign(ca_key, hashes.SHA256()))
+
+    paths = (os.path.join(directory, 'roots.pem'),
+             os.path.join(directory, 'broker_cert.pem'),
+             os.path.join(directory, 'broker_key.pem'))
+    with open(paths[0], 'wb') as f:
+        f.write(ca_cert.public_bytes(serialization.Encoding.PEM))
+    with open(paths[1], 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(paths[2], 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return paths
+
+
+def server_ssl_context(cert_file, key_file):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_file, key_file)
+    return context
+
+
+def load_public_key(path):
+    """Public key of a PEM certificate or public key file."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if b'CERTIFICATE' in data:
+        return x509.load_pem_x509_certificate(data).public_key()
+    return serialization.load_pem_public_key(data)
+
+
+def read_string(body, pos):
+    length, = struct.unpack_from('>H', body, pos)
+    return body[pos + 2:pos + 2 + length], pos + 2 + length
+
+
+def topic_matches(topic_filter, topic):
+    """MQTT filter matching, for the filters the gateway uses: exact topics
+    and a trailing multi-level '#'."""
+    if topic_filter.endswith('/#'):
+        prefix = topic_filter[:-2]
+        return topic == prefix or topic.startswith(prefix + '/')
+    return topic == topic_filter
+
+
+def encode_packet(packet_type, flags, body):
+    header = bytearray(((packet_type << 4) | flags,))
+    length = len(body)
+    while True:
+        byte, length = length % 128, length // 128
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            break
+    return bytes(header) + body
+
+
+class FakeBroker:
+    """MQTT server on host:port. on_message(topic, payload) is called for
+    every PUBLISH before it is acknowledged, on_acked(topic, payload) once
+    the PUBACK is written to the socket (right after on_message at QoS 0)."""
+
+    def __init__(self, ssl_context, verify_key, audience, host='127.0.0.1', port=0,
+                 on_message=None, puback_delay=0, on_acked=None):
+        self.ssl_context = ssl_context
+        self.verify_key = verify_key
+        self.audience = audience
+        self.host = host
+        self.port = port
+        self.on_message = on_message
+        self.puback_delay = puback_delay
+        self.on_acked = on_acked
+        self.server = None
+        self.connected = asyncio.Event()
+        self.connects = 0
+        self.rejected_connects = 0
+        self.publishes = collections.Counter()
+        # writer -> topic filters of each connected client
+        self.subscriptions = {}
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port, ssl=self.ssl_context)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def read_packet(self, reader):
+        first = (await reader.readexactly(1))[0]
+        length = 0
+        shift = 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return first >> 4, first & 0x0F, await reader.readexactly(length)
+
+    def check_connect(self, body):
+        """Returns the CONNACK return code for a CONNECT packet."""
+        _, pos = read_string(body, 0)
+        flags = body[pos + 1]
+        pos += 4
+        client_id, pos = read_string(body, pos)
+        if flags & 0x04:
+            _, pos = read_string(body, pos)
+            _, pos = read_string(body, pos)
+        if flags & 0x80:
+            _, pos = read_string(body, pos)
+        if not flags & 0x40:
+            return CONNACK_REFUSED_BAD_CREDENTIALS
+        password, pos = read_string(body, pos)
+        if not client_id.startswith(b'projects/'):
+            return CONNACK_REFUSED_NOT_AUTHORIZED
+        try:
+            jwt.decode(password, self.verify_key, algorithms=['RS256', 'ES256'], audience=self.audience)
+        except jwt.InvalidTokenError:
+            return CONNACK_REFUSED_NOT_AUTHORIZED
+        return CONNACK_ACCEPTED
+
+    def publish(self, topic, payload):
+        """Sends a message to the clients subscribed to topic. Returns how
+        many got it."""
+        packet = encode_packet(PUBLISH, 0, struct.pack('>H', len(topic)) + topic.encode() + payload)
+        receivers = 0
+        for writer, filters in self.subscriptions.items():
+            if any(topic_matches(topic_filter, topic) for topic_filter in filters):
+                writer.write(packet)
+                receivers += 1
+        return receivers
+
+    def disconnect_clients(self):
+        """Drops every connection, as the bridge does on errors."""
+        for writer in list(self.subscriptions):
+            writer.close()
+
+    async def puback_later(self, writer, packet_id, topic, payload):
+        await asyncio.sleep(self.puback_delay)
+        if writer.is_closing():
+            return
+        writer.write(encode_packet(PUBACK, 0, struct.pack('>H', packet_id)))
+        await writer.drain()
+        if self.on_acked is not None:
+            self.on_acked(topic, payload)
+
+    async def handle(self, reader, writer):
+        try:
+            packet_type, _, body = await self.read_packet(reader)
+            rc = self.check_connect(body) if packet_type == CONNECT else CONNACK_REFUSED_NOT_AUTHORIZED
+            writer.write(encode_packet(CONNACK, 0, bytes((0, rc))))
+            if rc != CONNACK_ACCEPTED:
+                self.rejected_connects += 1
+                return
+            self.connects += 1
+            self.connected.set()
+            filters = self.subscriptions[writer] = set()
+            while True:
+                packet_type, flags, body = await self.read_packet(reader)
+                acked = None
+                if packet_type == PUBLISH:
+                    qos = (flags >> 1) & 0x03
+                    topic, pos = read_string(body, 0)
+                    if qos:
+                        packet_id, = struct.unpack_from('>H', body, pos)
+                        pos += 2
+                    topic = topic.decode()
+                    payload = body[pos:]
+                    self.publishes[topic] += 1
+                    if self.on_message is not None:
+                        self.on_message(topic, payload)
+                    if qos and self.puback_delay:
+                        asyncio.ensure_future(self.puback_later(writer, packet_id, topic, payload))
+                    else:
+                        if qos:
+                            writer.write(encode_packet(PUBACK, 0, struct.pack('>H', packet_id)))
+                        acked = topic, payload
+                elif packet_type == SUBSCRIBE:
+                    packet_id, = struct.unpack_from('>H', body, 0)
+                    pos = 2
+                    granted = bytearray()
+                    while pos < len(body):
+                        topic_filter, pos = read_string(body, pos)
+                        filters.add(topic_filter.decode())
+                        granted.append(min(body[pos], 1))
+                        pos += 1
+                    writer.write(encode_packet(SUBACK, 0, struct.pack('>H', packet_id) + bytes(granted)))
+                elif packet_type == UNSUBSCRIBE:
+                    packet_id, = struct.unpack_from('>H', body, 0)
+                    pos = 2
+                    while pos < len(body):
+                        topic_filter, pos = read_string(body, pos)
+                        filters.discard(topic_filter.decode())
+                    writer.write(encode_packet(UNSUBACK, 0, struct.pack('>H', packet_id)))
+                elif packet_type == PINGREQ:
+                    writer.write(encode_packet(PINGRESP, 0, b''))
+                elif packet_type == DISCONNECT:
+                    return
+                await writer.drain()
+                if acked is not None and self.on_acked is not None:
+                    self.on_acked(*acked)
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            self.subscriptions.pop(writer, None)
+            writer.close()
+
+
+async def serve(args):
+    if args.tls_directory:
+        _, cert_file, key_file = write_tls_files(args.tls_directory)
+        print('CA certificate written to {}'.format(os.path.join(args.tls_directory, 'roots.pem')))
+    else:
+        cert_file, key_file = args.cert, args.key
+
+    def on_message(topic, payload):
+        print('{:.3f} {} {}'.format(time.time(), topic, payload[:200]))
+
+    broker = FakeBroker(server_ssl_context(cert_file, key_file), load_public_key(args.public_key),
+                        args.audience, args.host, args.port, on_message, args.puback_delay)
+    await broker.start()
+    print('Listening on {}:{}'.format(broker.host, broker.port))
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8883)
+    parser.add_argument('--public-key', required=True,
+                        help='Certificate or public key the gateway JWTs are verified with.')
+    parser.add_argument('--audience', required=True, help='Expected JWT audience, the project ID.')
+    parser.add_argument('--tls-directory', help='Generate a CA and server certificate in this directory.')
+    parser.add_argument('--cert', help='Server certificate, unless --tls-directory is given.')
+    parser.add_argument('--key', help='Server certificate key.')
+    parser.add_argument('--puback-delay', type=float, default=0, help='Seconds before each PUBACK.')
+    args = parser.parse_args()
+    if not args.tls_directory and not (args.cert and args.key):
+        parser.error('either --tls-directory or --cert and --key are required')
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
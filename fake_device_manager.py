@@ -0,0 +1,231 @@
+"""
+In-process stand-in for iot_v1.DeviceManagerClient, to run manager.py and
+the registry mirror offline.
+
+Keeps registries and devices in memory and implements the calls manager.py
+makes for devices and gateways: create, get, list (field masks, pages and
+gateway filters), delete, bind, unbind and config updates, with the errors
+of the real API (AlreadyExists, NotFound). Every RPC is counted in calls,
+a list page being one RPC, and the size of the devices returned in
+transferred_bytes. touch() plays device activity.
+
+Usage example, timing a mirror refresh of 5000 devices:
+
+    python fake_device_manager.py --devices 5000 --changed 50
+"""
+
+import argparse
+import collections
+import datetime
+import os
+import tempfile
+import threading
+import time
+
+from google.api_core.exceptions import AlreadyExists
+from google.api_core.exceptions import NotFound
+from google.cloud import iot_v1
+from google.protobuf import field_mask_pb2 as gp_field_mask
+
+import manager
+import registry_mirror
+
+# What list_devices returns without field mask, like the API.
+DEFAULT_LIST_PATHS = ("id", "num_id")
+
+
+def now():
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+
+class FakeDeviceManager:
+    """DeviceManagerClient over in-memory registries, safe to call from
+    several threads. List pages hold page_size devices unless the request
+    gives its own."""
+
+    def __init__(self, page_size=1000):
+        self.default_page_size = page_size
+        self.lock = threading.Lock()
+        # registry name -> {device ID: iot_v1.Device}
+        self.registries = {}
+        # (registry name, gateway ID) -> bound device IDs
+        self.bindings = collections.defaultdict(set)
+        self.num_ids = 0
+        self.calls = collections.Counter()
+        self.transferred_bytes = 0
+
+    def registry_path(self, project, location, registry):
+        return registry_mirror.registry_name(project, location, registry)
+
+    def device_path(self, project, location, registry, device):
+        return "{}/devices/{}".format(self.registry_path(project, location, registry), device)
+
+    def create_device_registry(self, request):
+        self.calls["create_device_registry"] += 1
+        registry = iot_v1.DeviceRegistry(request["device_registry"])
+        name = "{}/registries/{}".format(request["parent"], registry.id)
+        if name in self.registries:
+            raise AlreadyExists("Registry {} already exists".format(name))
+        self.registries[name] = {}
+        registry.name = name
+        return registry
+
+    def get_device_registry(self, request):
+        self.calls["get_device_registry"] += 1
+        if request["name"] not in self.registries:
+            raise NotFound("Registry {} not found".format(request["name"]))
+        return iot_v1.DeviceRegistry(id=request["name"].rsplit("/", 1)[1], name=request["name"])
+
+    def devices_of(self, registry):
+        try:
+            return self.registries[registry]
+        except KeyError:
+            raise NotFound("Registry {} not found".format(registry))
+
+    def find(self, name):
+        registry, _, device_id = name.rpartition("/devices/")
+        try:
+            return self.devices_of(registry)[device_id]
+        except KeyError:
+            raise NotFound("Device {} not found".format(name))
+
+    def masked(self, device, field_mask, default_paths=None):
+        """Copy of device with the fields of field_mask, counted as
+        transferred."""
+        if field_mask is None and default_paths is not None:
+            field_mask = gp_field_mask.FieldMask(paths=default_paths)
+        if field_mask is None:
+            result = iot_v1.Device(device)
+        else:
+            result = iot_v1.Device()
+            field_mask.MergeMessage(iot_v1.Device.pb(device), iot_v1.Device.pb(result))
+            # Always returned.
+            result.id = device.id
+            result.num_id = device.num_id
+        self.transferred_bytes += iot_v1.Device.pb(result).ByteSize()
+        return result
+
+    def create_device(self, request):
+        devices = self.devices_of(request["parent"])
+        device = iot_v1.Device(request["device"])
+        device.name = "{}/devices/{}".format(request["parent"], device.id)
+        device.config = iot_v1.DeviceConfig(version=1, cloud_update_time=now())
+        with self.lock:
+            self.calls["create_device"] += 1
+            if device.id in devices:
+                raise AlreadyExists("Device {} already exists".format(device.id))
+            self.num_ids += 1
+            device.num_id = self.num_ids
+            devices[device.id] = device
+        return self.masked(device, None)
+
+    def get_device(self, request):
+        self.calls["get_device"] += 1
+        return self.masked(self.find(request["name"]), request.get("field_mask"))
+
+    def delete_device(self, request):
+        self.calls["delete_device"] += 1
+        device = self.find(request["name"])
+        registry = request["name"].rpartition("/devices/")[0]
+        del self.registries[registry][device.id]
+        for (bound_registry, _), device_ids in self.bindings.items():
+            if bound_registry == registry:
+                device_ids.discard(device.id)
+
+    def list_devices(self, request):
+        """Generator of the devices, fetching a page (one RPC) whenever the
+        previous one is consumed, like the API pager."""
+        devices = self.devices_of(request["parent"])
+        options = request.get("gateway_list_options") or {}
+        if "gateway_type" in options:
+            gateway_type = options["gateway_type"]
+            selected = [device for device in devices.values()
+                        if (device.gateway_config.gateway_type == iot_v1.GatewayType.GATEWAY)
+                        == (gateway_type == iot_v1.GatewayType.GATEWAY)]
+        elif "associations_gateway_id" in options:
+            bound = self.bindings[(request["parent"], options["associations_gateway_id"])]
+            selected = [device for device in devices.values() if device.id in bound]
+        else:
+            selected = list(devices.values())
+        page_size = request.get("page_size") or self.default_page_size
+        for start in range(0, max(len(selected), 1), page_size):
+            self.calls["list_devices"] += 1
+            page = [self.masked(device, request.get("field_mask"), DEFAULT_LIST_PATHS)
+                    for device in selected[start:start + page_size]]
+            yield from page
+
+    def bind_device_to_gateway(self, request):
+        devices = self.devices_of(request["parent"])
+        for device_id in (request["gateway_id"], request["device_id"]):
+            if device_id not in devices:
+                raise NotFound("Device {} not found".format(device_id))
+        with self.lock:
+            self.calls["bind_device_to_gateway"] += 1
+            self.bindings[(request["parent"], request["gateway_id"])].add(request["device_id"])
+        return iot_v1.BindDeviceToGatewayResponse()
+
+    def unbind_device_from_gateway(self, request):
+        self.calls["unbind_device_from_gateway"] += 1
+        self.bindings[(request["parent"], request["gateway_id"])].discard(request["device_id"])
+        return iot_v1.UnbindDeviceFromGatewayResponse()
+
+    def modify_cloud_to_device_config(self, request):
+        self.calls["modify_cloud_to_device_config"] += 1
+        device = self.find(request["name"])
+        device.config = iot_v1.DeviceConfig(version=device.config.version + 1, cloud_update_time=now(),
+                                            binary_data=request["binary_data"])
+        # As if the device is connected and gets it right away.
+        device.last_config_send_time = now()
+        return device.config
+
+    def touch(self, registry, device_id, *fields):
+        """Records device activity: sets the given last_*_time fields, by
+        default last_event_time, to now."""
+        device = self.devices_of(registry)[device_id]
+        for field in fields or ("last_event_time",):
+            setattr(device, field, now())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=5000, help="Devices in the registry.")
+    parser.add_argument("--changed", type=int, default=50, help="Devices active between two refreshes.")
+    parser.add_argument("--page-size", type=int, default=1000, help="Devices per list page.")
+    args = parser.parse_args()
+
+    client = FakeDeviceManager(args.page_size)
+    manager.set_device_manager(None, "us-central1", client)
+    client.create_device_registry({"parent": "projects/fake/locations/us-central1",
+                                   "device_registry": {"id": "registry"}})
+    registry = registry_mirror.registry_name("fake", "us-central1", "registry")
+    client.create_device({"parent": registry, "device": {
+        "id": "gateway", "gateway_config": {"gateway_type": iot_v1.GatewayType.GATEWAY}}})
+    results = manager.bulk_provision(None, "fake", "us-central1", "registry",
+                                     [("device-{}".format(i), "gateway") for i in range(args.devices)],
+                                     requests_per_second=1e6)
+    assert not any(result["error"] for result in results)
+
+    with tempfile.TemporaryDirectory() as directory:
+        mirror = registry_mirror.RegistryMirror(os.path.join(directory, "mirror.db"))
+        for label in ("initial refresh", "unchanged refresh", "incremental refresh"):
+            if label == "incremental refresh":
+                for i in range(args.changed):
+                    client.touch(registry, "device-{}".format(i))
+            client.calls.clear()
+            client.transferred_bytes = 0
+            start = time.perf_counter()
+            written, removed = manager.refresh_mirror(mirror, None, "fake", "us-central1", "registry")
+            print("{:<20} {:>8.1f} ms {:>6} written {:>4} RPCs {:>9} bytes".format(
+                label, 1000 * (time.perf_counter() - start), written, sum(client.calls.values()),
+                client.transferred_bytes))
+        start = time.perf_counter()
+        devices = mirror.devices(registry)
+        bound = mirror.bound_devices(registry, "gateway")
+        print("{:<20} {:>8.1f} ms {:>6} devices {} bound".format(
+            "mirror read", 1000 * (time.perf_counter() - start), len(devices), len(bound)))
+        mirror.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,28 @@
+import array
+import asyncio
+import bisect
+import collections
 import datetime
+import functools
 import json
+import logging
+import logging.handlers
+import math
+import os
+import queue
+import random
 import ssl
+import sys
+import threading
 import time
 import jwt
 import paho.mqtt.client as mqtt
-from rfc3339 import rfc3339
+from cryptography.hazmat.primitives import serialization
+
+import metrics
+import payload_encoders
+import serial_frames
+import store_forward
 
 
 # Load config
@@ -15,7 +33,10 @@ my_id = config["my_id"]
 project_id = config["project_id"]
 service_account_json = config["service_account_json"]
 cloud_region = config["cloud_region"]
-serial_port = config["serial_port"]
+# One serial port, or a list of them served concurrently
+serial_ports = config["serial_port"]
+if isinstance(serial_ports, str):
+    serial_ports = [serial_ports]
 
 # Gateway parameters
 registry_id = f"registre-{my_id}"
@@ -25,10 +46,110 @@ certificate_file = "rsa_cert.pem"
 private_key_file = "rsa_private.pem"
 ca_certs = "roots.pem"
 algorithm = "RS256"
-mqtt_bridge_hostname = "mqtt.googleapis.com"
-mqtt_bridge_port = 8883
+# Overridden to run against fake_broker.py
+mqtt_bridge_hostname = config.get("mqtt_bridge_hostname", "mqtt.googleapis.com")
+mqtt_bridge_port = config.get("mqtt_bridge_port", 8883)
 jwt_expires_minutes = 1200
 
+# Serial reader parameters
+serial_buffer_frames = config.get("serial_buffer_frames", 1024)
+serial_max_frame_bytes = config.get("serial_max_frame_bytes", 256)
+serial_reopen_seconds = 5
+# Most frames the blocking runtime takes from the ring buffer between two
+# runs of paho's loop
+serial_frames_per_loop = 64
+# "ascii" for "#id,v1,v2" lines, "binary" for serial_frames frames
+serial_protocol = config.get("serial_protocol", "ascii")
+
+# Reading timestamps: "rfc3339" (UTC, millisecond precision) or "epoch_ms"
+timestamp_format = config.get("timestamp_format", "rfc3339")
+
+# Sensor nodes by serial node ID: device, event subfolder and the fields the
+# node sends, in order. Override with "sensors" in config.json.
+DEFAULT_SENSORS = {
+    "1": {"device_id": "canal-cleaner", "subfolder": "canal_cleaner",
+          "fields": [["obstruction", "int"]]},
+    "2": {"device_id": "weather-station", "subfolder": "weather_station",
+          "fields": [["humidity", "float"], ["temperature", "float"], ["water_level", "int"]]},
+}
+sensors = config.get("sensors", DEFAULT_SENSORS)
+
+# Gateway runtime: "loop" alternates paho's blocking loop with the serial
+# reader thread, "asyncio" multiplexes both on one event loop.
+gateway_runtime = config.get("gateway_runtime", "loop")
+
+# Reconnect backoff: wait a random time between 0 and
+# min(reconnect_max_seconds, reconnect_min_seconds * 2**attempt).
+reconnect_min_seconds = config.get("reconnect_min_seconds", 1)
+reconnect_max_seconds = config.get("reconnect_max_seconds", 300)
+# Rotate the JWT this long before it expires, and start signing the next
+# one token_prefetch_seconds before that.
+jwt_refresh_margin_minutes = 10
+token_prefetch_seconds = 60
+
+# Change-only publishing: per subfolder, the fields compared with the last
+# published reading of the device. A rule is "change" or a deadband
+# {"absolute": x} and/or {"percent": x}, e.g.
+#   {"weather_station": {"humidity": {"absolute": 1}, "water_level": "change"}}
+# A reading is published if any field passes its rule, or if
+# publish_heartbeat_seconds passed since the last published one.
+publish_filters = config.get("publish_filters", {})
+publish_heartbeat_seconds = config.get("publish_heartbeat_seconds", 300)
+
+# Edge aggregation: readings of the aggregate_subfolders are rolled into
+# clock aligned windows of aggregate_window_seconds, published as one summary
+# per device and window: <field>_min, <field>_max, <field>_mean and
+# <field>_last of every numeric field, and count. <field> itself is the mean
+# of float fields and the last value of int fields, as the rainfall model
+# reads them. With aggregate_passthrough the raw readings are published too.
+# Disabled when aggregate_window_seconds is 0.
+aggregate_window_seconds = config.get("aggregate_window_seconds", 0)
+aggregate_subfolders = config.get("aggregate_subfolders", ["weather_station"])
+aggregate_passthrough = config.get("aggregate_passthrough", False)
+
+# Telemetry payload encoding by subfolder: "json" (default), "json_template"
+# (the same JSON, formatted from a precomputed template), "cbor" or
+# "protobuf" (telemetry.proto), e.g. {"weather_station": "cbor"}.
+payload_encodings = config.get("payload_encodings", {})
+
+# Telemetry batching: readings of one device and subfolder are published
+# together as a JSON array. Disabled when batch_window_seconds is 0.
+batch_window_seconds = config.get("batch_window_seconds", 0)
+batch_max_readings = config.get("batch_max_readings", 50)
+
+# Store-and-forward: telemetry goes through a disk-backed queue and is
+# uploaded in order once connected, always at QoS 1 so that a message leaves
+# the queue only on its PUBACK, whatever telemetry_qos says. Disabled when
+# store_forward_path is unset.
+store_forward_path = config.get("store_forward_path")
+store_forward_max_messages = config.get("store_forward_max_messages", 100000)
+store_forward_drain_batch = 50
+
+# Telemetry QoS. Published messages wait in an in-flight window until
+# on_publish (the PUBACK at QoS 1); the gateway stops taking new readings
+# while inflight_window messages are waiting. After publish_timeout_seconds a
+# message leaves the window: sent again at QoS 0, left to paho's own resend
+# at QoS 1.
+telemetry_qos = config.get("telemetry_qos", 0)
+inflight_window = config.get("inflight_window", 20)
+publish_timeout_seconds = config.get("publish_timeout_seconds", 30)
+
+
+# Logging: records go through a bounded queue to a background thread that
+# writes them to stdout, so the gateway loop never blocks on the console.
+# log_level "DEBUG" also dumps every payload. Each message is logged at most
+# log_rate_limit times per log_rate_interval_seconds, the rest are counted
+# and reported with the next one let through.
+log_level = config.get("log_level", "INFO")
+log_rate_limit = config.get("log_rate_limit", 10)
+log_rate_interval_seconds = config.get("log_rate_interval_seconds", 60)
+log_queue_size = 10000
+
+# Metrics: Prometheus text format on http://metrics_host:metrics_port/metrics.
+# Disabled when metrics_port is unset.
+metrics_port = config.get("metrics_port")
+metrics_host = config.get("metrics_host", "127.0.0.1")
+
 
 class GatewayState:
     # This is the topic that the device will receive configuration updates on.
@@ -39,22 +160,160 @@ class GatewayState:
     mqtt_bridge_port = 8883
 
     # For all PUBLISH messages which are waiting for PUBACK. The key is 'mid'
-    # returned by publish().
+    # returned by publish(), see InflightWindow.
     pending_responses = {}
 
     # For all SUBSCRIBE messages which are waiting for SUBACK. The key is
     # 'mid'.
     pending_subscribes = {}
 
-    # for all SUBSCRIPTIONS. The key is subscription topic.
+    # for all SUBSCRIPTIONS. The key is subscription topic, the value the
+    # (serial reader, sensor node ID) its messages go to, see CommandRouter.
     subscriptions = {}
 
     # Indicates if MQTT client is connected or not
     connected = False
 
+    # Id of the last queued message handed to paho since the last connect.
+    outbox_cursor = 0
+
 gateway_state = GatewayState()
 
+
+class Clock:
+    """UTC wall clock anchored to time.monotonic_ns().
+
+    Readings are stamped with the monotonic time the serial bytes were
+    read, and converted to wall time when the event is built. The formatted
+    "YYYY-MM-DDTHH:MM:SS" prefix is cached for the current second, and the
+    anchor is refreshed every reanchor_seconds to follow NTP adjustments.
+    """
+
+    def __init__(self, fmt, reanchor_seconds=60):
+        self.fmt = fmt
+        self.reanchor_ns = reanchor_seconds * 1000000000
+        self.anchor()
+        self.cached_second = None
+        self.cached_prefix = ''
+
+    def anchor(self):
+        self.anchor_mono_ns = time.monotonic_ns()
+        self.anchor_wall_ns = time.time_ns()
+
+    def wall_ns(self, mono_ns=None):
+        """Wall clock time, in ns since the epoch, of monotonic time mono_ns
+        (now by default)."""
+        now = time.monotonic_ns()
+        if now - self.anchor_mono_ns > self.reanchor_ns:
+            self.anchor()
+        if mono_ns is None:
+            mono_ns = now
+        return self.anchor_wall_ns + mono_ns - self.anchor_mono_ns
+
+    def format(self, wall_ns):
+        if self.fmt == 'epoch_ms':
+            return wall_ns // 1000000
+        second, ns = divmod(wall_ns, 1000000000)
+        if second != self.cached_second:
+            self.cached_second = second
+            self.cached_prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(second))
+        return '{}.{:03d}Z'.format(self.cached_prefix, ns // 1000000)
+
+    def timestamp(self, mono_ns=None):
+        return self.format(self.wall_ns(mono_ns))
+
+
+clock = Clock(timestamp_format)
+
+
+# [START logging]
+logger = logging.getLogger('gateway')
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most `limit` records of each message, as passed to the
+    logger before formatting, every `interval` seconds."""
+
+    def __init__(self, limit, interval):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        # message -> [window start, records in window, suppressed records]
+        self.windows = {}
+        self.suppressed = 0
+
+    def filter(self, record):
+        now = time.monotonic()
+        window = self.windows.get(record.msg)
+        if window is None or now - window[0] >= self.interval:
+            suppressed = window[2] if window is not None else 0
+            window = self.windows[record.msg] = [now, 0, 0]
+            if suppressed:
+                record.msg = '{} ({} similar messages suppressed)'.format(record.msg, suppressed)
+        window[1] += 1
+        if window[1] > self.limit:
+            window[2] += 1
+            self.suppressed += 1
+            return False
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full instead of
+    reporting an error on stderr."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+log_listener = None
+
+
+def setup_logging():
+    """Send the gateway logs through the queue to stdout. Returns the
+    listener, stopped by stop_logging()."""
+    global log_listener
+    log_queue = queue.Queue(log_queue_size)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(RateLimitFilter(log_rate_limit, log_rate_interval_seconds))
+    logger.addHandler(handler)
+    logger.setLevel(log_level)
+    logger.propagate = False
+
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    log_listener = logging.handlers.QueueListener(log_queue, console)
+    log_listener.start()
+    return log_listener
+
+
+def stop_logging():
+    """Write out the queued records."""
+    if log_listener is not None:
+        log_listener.stop()
+# [END logging]
+
 # [START iot_mqtt_jwt]
+def load_private_key(private_key_file):
+    """Read and parse a PEM private key once per version of the file:
+    signing with the parsed key skips the PEM decoding on every token, and a
+    key rotated on disk is picked up by the next token."""
+    return _load_private_key(private_key_file, os.stat(private_key_file).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=4)
+def _load_private_key(private_key_file, mtime_ns):
+    with open(private_key_file, 'rb') as f:
+        return serialization.load_pem_private_key(f.read(), password=None)
+
+
 def create_jwt(project_id, private_key_file, algorithm, jwt_expires_minutes):
     """Creates a JWT (https://jwt.io) to establish an MQTT connection.
             Args:
@@ -83,17 +342,197 @@ def create_jwt(project_id, private_key_file, algorithm, jwt_expires_minutes):
         'aud': project_id
     }
 
-    # Read the private key file.
-    with open(private_key_file, 'r') as f:
-        private_key = f.read()
+    private_key = load_private_key(private_key_file)
 
-    print('Creating JWT using {} from private key file {}'.format(
-        algorithm, private_key_file))
+    logger.info('Creating JWT using %s from private key file %s', algorithm, private_key_file)
 
     return jwt.encode(token, private_key, algorithm=algorithm)
+
+
+class TokenProvider:
+    """Hands out JWTs without making the caller wait for the signature.
+
+    prefetch() signs the next token on a background thread; get() returns
+    it at once if it is still fresh, and signs one synchronously otherwise.
+    `issued` is the monotonic time the last token handed out was signed.
+    """
+
+    def __init__(self, project_id, private_key_file, algorithm, jwt_expires_minutes, max_prefetch_age=300):
+        self.project_id = project_id
+        self.private_key_file = private_key_file
+        self.algorithm = algorithm
+        self.jwt_expires_minutes = jwt_expires_minutes
+        self.max_prefetch_age = max_prefetch_age
+        self.lock = threading.Lock()
+        self.thread = None
+        self.next_token = None
+        self.issued = None
+
+    def mint(self):
+        issued = time.monotonic()
+        return issued, create_jwt(self.project_id, self.private_key_file, self.algorithm,
+                                  self.jwt_expires_minutes)
+
+    def prefetch(self):
+        """Start signing the next token in the background, unless one is
+        ready or already being signed."""
+        with self.lock:
+            if self.thread is not None or self.next_token is not None:
+                return
+            self.thread = threading.Thread(target=self._prefetch, name='jwt-prefetch', daemon=True)
+            self.thread.start()
+
+    def _prefetch(self):
+        next_token = self.mint()
+        with self.lock:
+            self.next_token = next_token
+            self.thread = None
+
+    def get(self):
+        with self.lock:
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+        with self.lock:
+            next_token, self.next_token = self.next_token, None
+        if next_token is None or time.monotonic() - next_token[0] > self.max_prefetch_age:
+            next_token = self.mint()
+        self.issued, token = next_token
+        return token
 # [END iot_mqtt_jwt]
 
 
+# [START iot_mqtt_reconnect]
+class ConnectionSupervisor:
+    """Owns the reconnects of the MQTT client.
+
+    The paho callbacks only report connects and disconnects; poll() then
+    reconnects after a jittered exponential backoff, so gateways that lose
+    the bridge together do not come back in lockstep. The bridge only checks
+    the JWT on connect, so the supervisor also rotates it shortly before it
+    expires with a planned reconnect.
+    """
+
+    def __init__(self, client, tokens, token_lifetime, refresh_margin, min_delay, max_delay):
+        self.client = client
+        self.tokens = tokens
+        self.token_lifetime = token_lifetime
+        self.refresh_margin = refresh_margin
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        # get_client() connected with a freshly minted token.
+        self.token_issued = time.monotonic()
+        self.attempt = 0
+        self.next_attempt = None
+        self.rotating = False
+        self.disconnected_since = None
+        self.reconnects = 0
+        self.failed_reconnects = 0
+        self.token_rotations = 0
+        self.downtime = 0.0
+
+    def token_age(self):
+        return time.monotonic() - self.token_issued
+
+    def token_due(self):
+        return self.token_age() >= self.token_lifetime - self.refresh_margin
+
+    def connecting(self):
+        """Whether a connect was sent and its CONNACK is still awaited."""
+        return not gateway_state.connected and self.next_attempt is None
+
+    def downtime_seconds(self):
+        """Total time spent disconnected, including the current outage."""
+        if self.disconnected_since is None:
+            return self.downtime
+        return self.downtime + time.monotonic() - self.disconnected_since
+
+    def on_connected(self):
+        if self.disconnected_since is not None:
+            self.downtime += time.monotonic() - self.disconnected_since
+            self.disconnected_since = None
+            self.reconnects += 1
+        self.attempt = 0
+        self.next_attempt = None
+
+    def on_disconnected(self):
+        now = time.monotonic()
+        if self.disconnected_since is None:
+            self.disconnected_since = now
+        if self.rotating:
+            # Our own disconnect to present a new token, come back at once.
+            self.rotating = False
+            self.next_attempt = now
+        else:
+            self.next_attempt = now + self.backoff()
+
+    def backoff(self):
+        delay = random.uniform(0, min(self.max_delay, self.min_delay * 2 ** self.attempt))
+        self.attempt += 1
+        return delay
+
+    def refresh_token(self):
+        self.client.username_pw_set(username='unused', password=self.tokens.get())
+        self.token_issued = self.tokens.issued
+        self.token_rotations += 1
+
+    def schedule(self):
+        """Rotate the token if it is time to. Returns (reconnect_due, seconds
+        until schedule() has something to do again). Never blocks: when a
+        reconnect is due the caller runs reconnect()."""
+        now = time.monotonic()
+        if self.token_age() >= self.token_lifetime - self.refresh_margin - token_prefetch_seconds:
+            # Have the next token signed by the time it is needed.
+            self.tokens.prefetch()
+        if self.next_attempt is not None:
+            if now < self.next_attempt:
+                return False, self.next_attempt - now
+            self.next_attempt = None
+            return True, 0.0
+        if gateway_state.connected and not self.rotating and self.token_due():
+            logger.info('JWT expires soon, reconnecting with a new one')
+            self.rotating = True
+            self.refresh_token()
+            self.client.disconnect()
+        return False, max(0.0, self.token_lifetime - self.refresh_margin - self.token_age())
+
+    def reconnect(self):
+        """Connect again, with a new token if the current one is due. Blocks
+        for DNS, TCP and TLS, up to the connect timeout."""
+        if self.token_due():
+            self.refresh_token()
+        try:
+            logger.info('Reconnecting to %s:%s',
+                        gateway_state.mqtt_bridge_hostname, gateway_state.mqtt_bridge_port)
+            self.client.reconnect()
+        except OSError as e:
+            self.failed_reconnects += 1
+            logger.warning('Reconnect failed: %s', e)
+            self.next_attempt = time.monotonic() + self.backoff()
+
+    def poll(self):
+        """Reconnect or rotate the token if it is time to, in place. Returns
+        the number of seconds until poll() has something to do again."""
+        reconnect_due, delay = self.schedule()
+        if reconnect_due:
+            self.reconnect()
+            _, delay = self.schedule()
+        return delay
+
+supervisor = None
+
+
+def start_supervisor(client):
+    global supervisor
+    supervisor = ConnectionSupervisor(
+        client,
+        TokenProvider(project_id, private_key_file, algorithm, jwt_expires_minutes),
+        jwt_expires_minutes * 60, jwt_refresh_margin_minutes * 60,
+        reconnect_min_seconds, reconnect_max_seconds)
+    return supervisor
+# [END iot_mqtt_reconnect]
+
+
 # [START iot_mqtt_config]
 def error_str(rc):
     """Convert a Paho error to a human readable string."""
@@ -102,9 +541,16 @@ def error_str(rc):
 
 def on_connect(client, unused_userdata, unused_flags, rc):
     """Callback for when a device connects."""
-    print('on_connect', mqtt.connack_string(rc))
+    logger.info('on_connect %s', mqtt.connack_string(rc))
 
-    gateway_state.connected = True
+    gateway_state.connected = rc == mqtt.CONNACK_ACCEPTED
+    if gateway_state.connected:
+        supervisor.on_connected()
+        attached_devices.on_connected(client)
+        # Subscriptions do not survive a clean session. The bridge only
+        # takes them after the attach, which was sent first.
+        if gateway_state.subscriptions:
+            client.subscribe([(topic, 1) for topic in gateway_state.subscriptions])
 
     # Subscribe to the config topic.
     #client.subscribe(gateway_state.mqtt_config_topic, qos=1)
@@ -112,53 +558,40 @@ def on_connect(client, unused_userdata, unused_flags, rc):
 
 def on_disconnect(client, unused_userdata, rc):
     """Paho callback for when a device disconnects."""
-    print('on_disconnect', error_str(rc))
+    logger.warning('on_disconnect %s', error_str(rc))
     gateway_state.connected = False
+    attached_devices.on_disconnected()
+
+    if telemetry_qos == 0 and outbox is None:
+        # paho drops the QoS 0 messages it could not write. QoS 1 ones, which
+        # include all the queued ones, paho resends itself.
+        inflight.clear()
 
-    # re-connect
-    # NOTE: should implement back-off here, but it's a tutorial
-    client.connect(
-        gateway_state.mqtt_bridge_hostname, gateway_state.mqtt_bridge_port)
+    # Reconnects are scheduled by the supervisor, never from the callback.
+    supervisor.on_disconnected()
 
 
-def on_publish(unused_client, userdata, mid):
+def on_publish(client, userdata, mid):
     """Paho callback when a message is sent to the broker."""
-    print('on_publish, userdata {}, mid {}'.format(userdata, mid))
-    """
-    try:
-        client_addr, message = gateway_state.pending_responses.pop(mid)
-        print(client_addr, message)
-        #udpSerSock.sendto(message.encode(), client_addr)
-        print('Pending response count {}'.format(
-                len(gateway_state.pending_responses)))
-    except KeyError:
-        print('Unable to find key {}'.format(mid))
-    """
+    logger.debug('on_publish, userdata %s, mid %s', userdata, mid)
+    if attached_devices.ack(client, mid):
+        return
+    message_id = inflight.ack(mid)
+    if message_id is not None:
+        outbox.ack(message_id)
 
 
 def on_subscribe(unused_client, unused_userdata, mid, granted_qos):
-    print('on_subscribe: mid {}, qos {}'.format(mid, granted_qos))
-    """
-    try:
-        client_addr, response = gateway_state.pending_subscribes[mid]
-        #udpSerSock.sendto(response.encode(), client_addr)
-    except KeyError:
-        print('Unable to find mid: {}'.format(mid))
-    """
+    logger.info('on_subscribe: mid %s, qos %s', mid, granted_qos)
 
 
 def on_message(unused_client, unused_userdata, message):
     """Callback when the device receives a message on a subscription."""
-    payload = message.payload
-    qos = message.qos
-    print('Received message \'{}\' on topic \'{}\' with Qos {}'.format(
-            payload.decode("utf-8"), message.topic, qos))
-    try:
-        client_addr = gateway_state.subscriptions[message.topic]
-        #udpSerSock.sendto(payload, client_addr)
-        print('Sent message to device')
-    except KeyError:
-        print('Nobody subscribes to topic {}'.format(message.topic))
+    received = time.monotonic()
+    logger.debug('Received message \'%s\' on topic \'%s\' with Qos %s',
+                 message.payload, message.topic, message.qos)
+    if not command_router.dispatch(message.topic, message.payload, received):
+        logger.warning('Nobody subscribes to topic %s', message.topic)
 
 
 def get_client(project_id, cloud_region, registry_id, gateway_id, private_key_file, algorithm, ca_certs,
@@ -197,104 +630,1303 @@ def get_client(project_id, cloud_region, registry_id, gateway_id, private_key_fi
 
 def attach_device(client, device_id):
     attach_topic = '/devices/{}/attach'.format(device_id)
-    print(attach_topic)
+    logger.info('Attaching %s', device_id)
     return client.publish(attach_topic, "", qos=1)
 
 
 def detatch_device(client, device_id):
     detach_topic = '/devices/{}/detach'.format(device_id)
-    print(detach_topic)
+    logger.info('Detaching %s', device_id)
     return client.publish(detach_topic, "", qos=1)
 
 
+class AttachedDevices:
+    """The devices the sensor nodes asked to attach, and whether the bridge
+    acknowledged it on the current connection.
+
+    A device is attached once its attach gets a PUBACK. Attach and detach
+    requests that would not change anything are not published. On every
+    connect all devices are attached again in one go, and telemetry of a
+    device waiting for its attach PUBACK is held, up to hold_limit messages
+    per device, then published in order once the PUBACK arrives.
+    """
+
+    def __init__(self, hold_limit):
+        self.hold_limit = hold_limit
+        # device -> attach mid while waiting for its PUBACK, None once attached
+        # or while disconnected
+        self.devices = {}
+        self.attached = set()
+        self.attach_mids = {}
+        # device -> (topic, payload) deque
+        self.held = {}
+        self.duplicates = 0
+        self.dropped = 0
+
+    def ready(self, device_id):
+        """Whether telemetry of device_id can be published. Devices that
+        never asked to be attached are not held."""
+        return device_id not in self.devices or device_id in self.attached
+
+    def pending(self):
+        """Whether some attach is waiting for its PUBACK."""
+        return bool(self.attach_mids)
+
+    def publish_attach(self, client, device_id):
+        info = attach_device(client, device_id)
+        if info.rc == mqtt.MQTT_ERR_SUCCESS:
+            self.devices[device_id] = info.mid
+            self.attach_mids[info.mid] = device_id
+        return info.mid
+
+    def attach(self, client, device_id):
+        """Returns the mid of the attach, or None if none was published."""
+        if device_id in self.devices:
+            self.duplicates += 1
+            return None
+        self.devices[device_id] = None
+        if not gateway_state.connected:
+            # Attached by on_connected.
+            return None
+        return self.publish_attach(client, device_id)
+
+    def detach(self, client, device_id):
+        """Returns the mid of the detach, or None if none was published."""
+        if device_id not in self.devices:
+            self.duplicates += 1
+            return None
+        self.attach_mids.pop(self.devices.pop(device_id), None)
+        self.attached.discard(device_id)
+        self.dropped += len(self.held.pop(device_id, ()))
+        if not gateway_state.connected:
+            return None
+        _, mid = detatch_device(client, device_id)
+        return mid
+
+    def hold(self, device_id, topic, payload):
+        held = self.held.get(device_id)
+        if held is None:
+            held = self.held[device_id] = collections.deque(maxlen=self.hold_limit)
+        if len(held) == held.maxlen:
+            self.dropped += 1
+        held.append((topic, payload))
+
+    def ack(self, client, mid):
+        """Handles the PUBACK of an attach. Returns False if mid is not one."""
+        device_id = self.attach_mids.pop(mid, None)
+        if device_id is None:
+            return False
+        self.devices[device_id] = None
+        self.attached.add(device_id)
+        for topic, payload in self.held.pop(device_id, ()):
+            send_telemetry(client, topic, payload)
+        return True
+
+    def on_connected(self, client):
+        """Attach every device again, pipelined. Attaches still waiting for
+        their PUBACK are published again by paho itself."""
+        for device_id, mid in list(self.devices.items()):
+            if mid is None:
+                self.publish_attach(client, device_id)
+
+    def on_disconnected(self):
+        self.attached.clear()
+
+
+attached_devices = AttachedDevices(serial_buffer_frames)
+
+
 # [START Serial port]
-def read_serial_data(ser):
-  """Read Arduino sensors from serial interface"""
-  try:
-      response = serial_receive(ser)
-      response = response.rstrip().decode()
-      print('Received from Arduino: {}'.format(response))
-  except IOError:
-    print('I/O Error')
-    return None
-  return response
+class LineFramer:
+    """Splits a serial byte stream into newline terminated frames."""
 
+    def __init__(self, max_frame_bytes):
+        self.max_frame_bytes = max_frame_bytes
+        self.partial = b''
+        self.discarding = False
+        self.dropped_frames = 0
 
-def serial_receive(ser):
-  """Write string to serial connection and return any response."""
-  while True:
-    try:
-      time.sleep(0.01)
-      state = ser.readline()
-      if state:
-        return state
-    except:
-      pass
-  sleep(0.1)
-  return 'E'
+    def feed(self, data):
+        """Returns the complete frames found in data, without line endings."""
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        frames = []
+        for line in lines:
+            if self.discarding:
+                # Tail of an oversized frame, already counted as dropped.
+                self.discarding = False
+                continue
+            line = line.rstrip(b'\r')
+            if len(line) > self.max_frame_bytes:
+                self.dropped_frames += 1
+            elif line:
+                frames.append(line)
+        if len(self.partial) > self.max_frame_bytes:
+            # No line ending in sight, the sender is out of sync or talking
+            # garbage. Drop everything up to the next line ending.
+            if not self.discarding:
+                self.dropped_frames += 1
+                self.discarding = True
+            self.partial = b''
+        return frames
+
+
+class SerialReader:
+    """Reads frames from one serial port on a background thread.
+
+    Complete frames are kept in a bounded ring buffer until the publish loop
+    takes them. When the buffer is full the oldest frame is overwritten and
+    counted as an overrun. If the port fails or is unplugged it is closed
+    and opened again every serial_reopen_seconds, without affecting the
+    readers of other ports. Readers of several ports share one `ready`
+    condition so that SerialPorts can wait on all of them.
+    """
+
+    def __init__(self, port, open_port, framer, capacity, ready=None):
+        self.port = port
+        self.open_port = open_port
+        self.ser = None
+        self.framer = framer
+        self.frames = collections.deque(maxlen=capacity)
+        self.ready = ready or threading.Condition()
+        self.frames_read = 0
+        self.overruns = 0
+        self.read_errors = 0
+        self.parse_errors = 0
+        self.opens = 0
+        self.running = False
+        self.thread = None
+        self.writer = SerialWriter(self)
+
+    @property
+    def dropped_frames(self):
+        return self.framer.dropped_frames
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='serial-reader {}'.format(self.port), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def open(self):
+        try:
+            self.ser = self.open_port(self.port)
+        except OSError as e:
+            logger.error('Cannot open serial port %s: %s', self.port, e)
+            return False
+        self.opens += 1
+        return True
+
+    def close(self):
+        if self.ser is not None:
+            try:
+                self.ser.close()
+            except OSError:
+                pass
+            self.ser = None
+
+    def run(self):
+        while self.running:
+            if self.ser is None and not self.open():
+                time.sleep(serial_reopen_seconds)
+                continue
+            try:
+                # Blocks until a byte arrives or the port timeout expires,
+                # then takes whatever else is already waiting.
+                data = self.ser.read(self.ser.in_waiting or 1)
+            except OSError as e:
+                self.read_errors += 1
+                logger.error('Serial read error on %s: %s', self.port, e)
+                self.close()
+                continue
+            if data:
+                self.feed(data)
+
+    def feed(self, data):
+        frames = self.framer.feed(data)
+        if not frames:
+            return
+        captured = time.monotonic_ns()
+        with self.ready:
+            for frame in frames:
+                if len(self.frames) == self.frames.maxlen:
+                    self.overruns += 1
+                self.frames.append((captured, frame))
+            self.frames_read += len(frames)
+            self.ready.notify()
+
+    def get(self, timeout=None):
+        """Returns the oldest buffered frame, or None if nothing arrived
+        within timeout seconds."""
+        with self.ready:
+            if not self.frames:
+                self.ready.wait(timeout)
+            if self.frames:
+                return self.frames.popleft()[1]
+            return None
+
+
+class SerialWriter:
+    """Writes to the port of a SerialReader from its own thread, so writes
+    neither block the caller nor wait for the reader.
+
+    Messages are queued by send() and written in order. The time from
+    send() to the end of the write goes to a histogram. Messages sent while
+    the port is closed are dropped and counted as write errors.
+    """
+
+    # Upper bounds of the latency histogram buckets, in seconds
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, float('inf'))
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.written = 0
+        self.write_errors = 0
+        self.latency_counts = [0] * len(self.LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+
+    def send(self, data, queued=None):
+        """Queue data for the port. queued is the time.monotonic() the
+        latency is measured from, now by default."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='serial-writer {}'.format(self.reader.port),
+                                           daemon=True)
+            self.thread.start()
+        self.queue.put((time.monotonic() if queued is None else queued, data))
+
+    def run(self):
+        while True:
+            queued, data = self.queue.get()
+            ser = self.reader.ser
+            try:
+                if ser is None:
+                    raise OSError('port is closed')
+                ser.write(data)
+            except OSError as e:
+                self.write_errors += 1
+                logger.error('Serial write error on %s: %s', self.reader.port, e)
+                continue
+            latency = time.monotonic() - queued
+            self.latency_counts[bisect.bisect_left(self.LATENCY_BUCKETS, latency)] += 1
+            self.latency_sum += latency
+            self.written += 1
+
+
+class SerialPorts:
+    """The readers of all serial ports. Frames are taken round robin, so a
+    busy port cannot starve the others."""
+
+    def __init__(self, readers, ready):
+        self.readers = readers
+        self.ready = ready
+        self.next = 0
+
+    def take(self):
+        count = len(self.readers)
+        for i in range(count):
+            reader = self.readers[(self.next + i) % count]
+            if reader.frames:
+                self.next = (self.next + i + 1) % count
+                return (reader,) + reader.frames.popleft()
+        return None
+
+    def has_frames(self):
+        return any(reader.frames for reader in self.readers)
+
+    def get(self, timeout=None):
+        """Returns (reader, capture time, frame) for the next frame, or None
+        if nothing arrived within timeout seconds. The capture time is the
+        time.monotonic_ns() the frame was read at."""
+        with self.ready:
+            item = self.take()
+            if item is None:
+                self.ready.wait(timeout)
+                item = self.take()
+            return item
+
+
+def read_serial_data(ports, timeout=None):
+  """Read Arduino sensors from serial interface. Returns the reader of the
+  port it came from, the capture time and the data, or None."""
+  item = ports.get(timeout)
+  if item is None:
+    return None
+  reader, captured, frame = item
+  if serial_protocol == 'binary':
+    return item
+  try:
+      response = frame.decode()
+      logger.debug('Received from Arduino on %s: %s', reader.port, response)
+  except UnicodeDecodeError:
+    reader.parse_errors += 1
+    logger.warning('Undecodable frame from Arduino on %s: %s', reader.port, frame)
+    return None
+  return reader, captured, response
 
 
 def init_serial(serial_port):
   import serial
-  print('Creating and flushing serial port.')
+  logger.info('Creating and flushing serial port.')
   ser = serial.Serial(serial_port)
   with ser:
-    ser.setDTR(False)
-    time.sleep(1)
-    ser.flushInput()
-    ser.setDTR(True)
+    try:
+      # Toggling DTR resets the Arduino. Pseudo-terminals, such as the one
+      # of virtual_arduino.py, have no modem lines.
+      ser.setDTR(False)
+      time.sleep(1)
+      ser.flushInput()
+      ser.setDTR(True)
+    except OSError:
+      pass
   ser = serial.Serial(serial_port, 9600, timeout=0.1)
   return ser
 
 
-def get_devive_id(id):
-    if (id == "1"):
-        return "canal-cleaner"
-    elif (id == "2"):
-        return "weather-station"
-    else :
+def create_framer():
+  """Framer matching the configured serial protocol."""
+  if serial_protocol == 'binary':
+    return serial_frames.BinaryFramer()
+  return LineFramer(serial_max_frame_bytes)
+
+
+def create_serial_ports(open_port=None):
+  """One reader per configured serial port, not started."""
+  ready = threading.Condition()
+  readers = [SerialReader(port, open_port or init_serial, create_framer(), serial_buffer_frames, ready)
+             for port in serial_ports]
+  return SerialPorts(readers, ready)
+
+
+def start_serial_reader(port, open_port=None):
+  """Start a background reader of a single port."""
+  reader = SerialReader(port, open_port or init_serial, create_framer(), serial_buffer_frames)
+  reader.start()
+  return reader
+
+
+class SensorSchema:
+    """Maps the field values sent by one type of sensor node to its
+    telemetry event."""
+
+    FIELD_TYPES = {"int": int, "float": float, "str": str}
+
+    def __init__(self, node_id, device_id, subfolder, fields):
+        self.node_id = node_id
+        self.device_id = device_id
+        self.subfolder = subfolder
+        # (field name, converter) in the order the node sends them
+        self.fields = tuple((name, self.FIELD_TYPES[field_type]) for name, field_type in fields)
+
+    def event(self, values, timestamp):
+        if len(values) < len(self.fields):
+            raise ValueError('expected {} values, got {}'.format(len(self.fields), len(values)))
+        data = {"device_id": self.device_id}
+        for (name, convert), value in zip(self.fields, values):
+            data[name] = convert(value)
+        data["timestamp"] = timestamp
+        return {"action": "event", "device": self.device_id, "subfolder": self.subfolder, "data": data}
+
+
+def load_sensor_schemas(sensors):
+    """Build the node ID -> SensorSchema registry from the "sensors" config."""
+    return {node_id: SensorSchema(node_id, sensor["device_id"], sensor["subfolder"], sensor["fields"])
+            for node_id, sensor in sensors.items()}
+
+
+sensor_schemas = load_sensor_schemas(sensors)
+
+
+def create_payload_encoders(schemas):
+    """subfolder -> payload encoder, see payload_encodings."""
+    timestamp_type = int if timestamp_format == 'epoch_ms' else str
+    return {schema.subfolder: payload_encoders.create_encoder(
+                payload_encodings.get(schema.subfolder, "json"),
+                schema.fields, timestamp_type)
+            for schema in schemas.values()}
+
+
+encoders = create_payload_encoders(sensor_schemas)
+default_encoder = payload_encoders.JsonEncoder()
+
+# Serial commands that are not sensor readings
+CONTROL_ACTIONS = {"attach", "detach", "subscribe"}
+CONTROL_FRAMES = {
+    serial_frames.ATTACH: "attach",
+    serial_frames.DETACH: "detach",
+    serial_frames.SUBSCRIBE: "subscribe",
+}
+
+
+def control_command(action, id):
+    schema = sensor_schemas.get(id)
+    return {"action": action, "device": schema.device_id if schema else None, "node": id}
+
+
+def parse_sensors_data(data, captured=None):
+    if not data or data[0] != '#':
+        logger.warning('Error getting Arduino sensor values over serial')
+        return None
+    sensors_data = data[1:].split(",")
+    command = sensors_data[0]
+    try:
+        if command in CONTROL_ACTIONS:
+            return control_command(command, sensors_data[1])
+        schema = sensor_schemas.get(command)
+        if schema is None:
+            logger.warning('Unrecognized sensor node ID')
+            return None
+        return schema.event(sensors_data[1:], clock.timestamp(captured))
+    except (IndexError, ValueError):
+        logger.warning('Malformed sensor values from Arduino: %s', data)
         return None
 
 
-def parse_sensors_data(data):
-    if data[0] == '#':
-        sensors_data = data.split("#")[1]
-        command = sensors_data.split(",")[0]
-        if (command == "detach"):
-            id = sensors_data.split(",")[1]
-            device = get_devive_id(id)
-            return {"action": "detach", "device": device}
-        elif (command == "attach"):
-            id = sensors_data.split(",")[1]
-            device = get_devive_id(id)
-            return {"action": "attach", "device": device}
-        else :
-            id = sensors_data.split(",")[0]
-            device = get_devive_id(id)
-            timestamp = rfc3339(datetime.datetime.now())
-            if (id == "1"):
-                obstruction = int(sensors_data.split(",")[1])
-                data = {"device_id": device, "obstruction": obstruction, "timestamp": timestamp}
-                return {"action": "event", "device": device, "subfolder": "canal_cleaner", "data": data}
-            elif (id == "2"):
-                humidity = float(sensors_data.split(",")[1])
-                temperature = float(sensors_data.split(",")[2])
-                water_level = int(sensors_data.split(",")[3])
-                data = {"device_id": device, "humidity": humidity, "temperature": temperature,
-                        "water_level": water_level, "timestamp": timestamp}
-                return {"action": "event", "device": device, "subfolder": "weather_station", "data": data}
-            else:
-                print("Unrecongnized sensor node ID")
-                return None
-    else:
-        print('Error getting Arduino sensor values over serial')
+def parse_binary_frame(frame, captured=None):
+    """Same as parse_sensors_data for a frame of the binary protocol. Only
+    node types with a layout in serial_frames.FRAME_FORMATS can use it."""
+    frame_type, values = serial_frames.decode_frame(frame)
+    if frame_type in CONTROL_FRAMES:
+        return control_command(CONTROL_FRAMES[frame_type], str(values[0]))
+    schema = sensor_schemas.get(str(frame_type))
+    if schema is None:
+        logger.warning('Unrecognized sensor node ID')
         return None
+    return schema.event(values, clock.timestamp(captured))
 # [END Serial port]
 
 
+# [START iot_mqtt_commands]
+class CommandRouter:
+    """Forwards the config and commands messages of subscribed devices to
+    the sensor node on the serial port that asked for them.
+
+    Routes are kept in `routes` (gateway_state.subscriptions) by topic
+    filter: /devices/<id>/config and /devices/<id>/commands/#. A message
+    topic maps to one of them directly, so dispatch takes one lookup
+    whatever the number of devices and command subfolders.
+
+    On the serial line a config is sent as "#config,<node>,<payload>" and a
+    command as "#command,<node>,<subfolder>,<payload>", or as
+    serial_frames CONFIG and COMMAND frames with the binary protocol.
+    """
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.dispatched = 0
+
+    def add(self, device_id, reader, node_id):
+        """Routes the messages of device_id to node_id on reader's port.
+        Returns the topic filters to subscribe to."""
+        topics = ['/devices/{}/config'.format(device_id), '/devices/{}/commands/#'.format(device_id)]
+        for topic in topics:
+            self.routes[topic] = (reader, node_id)
+        return topics
+
+    def remove(self, device_id):
+        """Returns the topic filters to unsubscribe from."""
+        topics = ['/devices/{}/config'.format(device_id), '/devices/{}/commands/#'.format(device_id)]
+        return [topic for topic in topics if self.routes.pop(topic, None) is not None]
+
+    def dispatch(self, topic, payload, received):
+        """Queues a message for its sensor node. Returns False if no route
+        matches topic."""
+        # '', 'devices', device ID, 'config' or 'commands', subfolder
+        parts = topic.split('/', 4)
+        if len(parts) < 4 or parts[1] != 'devices':
+            return False
+        if parts[3] == 'config':
+            route = self.routes.get(topic)
+            kind, body = serial_frames.CONFIG, payload
+        elif parts[3] == 'commands':
+            route = self.routes.get('/devices/{}/commands/#'.format(parts[2]))
+            subfolder = parts[4] if len(parts) > 4 else ''
+            kind, body = serial_frames.COMMAND, subfolder.encode() + b',' + payload
+        else:
+            return False
+        if route is None:
+            return False
+        if kind == serial_frames.CONFIG and not payload:
+            # No configuration set for the device.
+            return True
+        reader, node_id = route
+        try:
+            data = encode_serial_message(kind, node_id, body)
+        except ValueError as e:
+            logger.warning('Cannot forward %s to node %s: %s', topic, node_id, e)
+            return True
+        reader.writer.send(data, received)
+        self.dispatched += 1
+        return True
+
+
+def encode_serial_message(kind, node_id, body):
+    if serial_protocol == 'binary':
+        return serial_frames.encode_message(kind, int(node_id), body)
+    name = 'config' if kind == serial_frames.CONFIG else 'command'
+    # One line per message: the payload cannot hold a line break.
+    text = body.decode('utf-8').replace('\r', ' ').replace('\n', ' ')
+    return '#{},{},{}\n'.format(name, node_id, text).encode('utf-8')
+
+
+command_router = CommandRouter(gateway_state.subscriptions)
+
+
+def subscribe_device(client, reader, node_id, device_id):
+    """Subscribe to the config and commands of an attached device and
+    route them to its node."""
+    topics = command_router.add(device_id, reader, node_id)
+    if gateway_state.connected:
+        return client.subscribe([(topic, 1) for topic in topics])
+    # Subscribed by on_connect.
+    return mqtt.MQTT_ERR_NO_CONN, None
+# [END iot_mqtt_commands]
+
+
+# [START iot_mqtt_inflight]
+class InflightWindow:
+    """Telemetry messages handed to paho and waiting for on_publish, which
+    at QoS 1 means waiting for the PUBACK.
+
+    Messages are kept in `messages` (gateway_state.pending_responses) keyed
+    by 'mid', oldest first. The publish path holds back while full(), and the
+    publish to PUBACK latency of every message goes to a histogram. QoS 1
+    messages that time out leave the window but stay in `late`, since paho
+    still resends them and their PUBACK acknowledges them in the queue.
+    """
+
+    # Upper bounds of the latency histogram buckets, in seconds
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+    def __init__(self, messages, size, timeout):
+        self.messages = messages
+        self.size = size
+        self.timeout = timeout
+        self.latency_counts = [0] * len(self.LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.acked = 0
+        self.retransmits = 0
+        self.timeouts = 0
+        # mid -> store-and-forward queue id of the timed out QoS 1 messages
+        self.late = {}
+
+    def free(self):
+        return max(0, self.size - len(self.messages))
+
+    def full(self):
+        return len(self.messages) >= self.size
+
+    def add(self, mid, topic, payload, message_id, qos):
+        self.messages[mid] = (time.monotonic(), topic, payload, message_id, qos)
+
+    def ack(self, mid):
+        """Removes an acknowledged message. Returns its store-and-forward
+        queue id, if it has one."""
+        entry = self.messages.pop(mid, None)
+        if entry is None:
+            return self.late.pop(mid, None)
+        latency = time.monotonic() - entry[0]
+        self.latency_counts[bisect.bisect_left(self.LATENCY_BUCKETS, latency)] += 1
+        self.latency_sum += latency
+        self.acked += 1
+        return entry[3]
+
+    def expired(self):
+        """Removes the messages waiting for longer than the timeout and
+        returns the (topic, payload, queue id) of the QoS 0 ones, which paho
+        will not send again."""
+        deadline = time.monotonic() - self.timeout
+        mids = []
+        for mid, entry in self.messages.items():
+            if entry[0] >= deadline:
+                break
+            mids.append(mid)
+        resend = []
+        for mid in mids:
+            _, topic, payload, message_id, qos = self.messages.pop(mid)
+            self.timeouts += 1
+            if qos:
+                self.late[mid] = message_id
+            else:
+                resend.append((topic, payload, message_id))
+        return resend
+
+    def clear(self):
+        self.messages.clear()
+        self.late.clear()
+
+
+inflight = InflightWindow(gateway_state.pending_responses, inflight_window, publish_timeout_seconds)
+
+# Telemetry messages paho took, by subfolder
+published_messages = collections.Counter()
+
+
+def send_telemetry(client, topic, payload, message_id=None):
+    """Publish a telemetry message and track it until on_publish. Messages
+    of the store-and-forward queue (with a message_id) go at QoS 1: at QoS 0
+    on_publish only means written to the socket, and the queue would delete
+    messages a dying connection never delivered. Returns False if paho did
+    not take it."""
+    logger.debug('Publishing message to topic %s with payload \'%s\'', topic, payload)
+    qos = telemetry_qos if message_id is None else 1
+    info = client.publish(topic, payload, qos=qos)
+    if info.rc != mqtt.MQTT_ERR_SUCCESS:
+        return False
+    published_messages[topic.rpartition('/')[2]] += 1
+    # A QoS 0 message written out before publish() returned got its
+    # on_publish before we knew its mid: nothing to track.
+    if not info.is_published():
+        inflight.add(info.mid, topic, payload, message_id, qos)
+    return True
+
+
+def retransmit_expired(client):
+    """Publish again the QoS 0 messages still not written out in time. QoS 1
+    ones are resent by paho itself, under their mid, after a reconnect;
+    publishing them again would only duplicate them past the window."""
+    if not gateway_state.connected:
+        return
+    for topic, payload, message_id in inflight.expired():
+        inflight.retransmits += 1
+        logger.warning('Not written out after %s s, publishing again to %s', publish_timeout_seconds, topic)
+        send_telemetry(client, topic, payload, message_id)
+# [END iot_mqtt_inflight]
+
+
+# [START iot_mqtt_filter]
+class ChangeFilter:
+    """Drops readings that carry nothing new, see publish_filters.
+
+    Counts the readings seen and suppressed per (device, subfolder), exported
+    as gateway_filter_seen_total and gateway_filter_suppressed_total, so the
+    thresholds can be tuned from the suppression ratio.
+    """
+
+    def __init__(self, filters, heartbeat_seconds):
+        self.heartbeat_seconds = heartbeat_seconds
+        # subfolder -> ((field, absolute deadband, percent deadband), ...),
+        # without deadband for the "change" rules
+        self.rules = {subfolder: tuple(self.compile_rule(name, rule) for name, rule in fields.items())
+                      for subfolder, fields in filters.items()}
+        # (device, subfolder) -> (time it was published, last published data)
+        self.last = {}
+        self.seen = collections.Counter()
+        self.suppressed = collections.Counter()
+
+    @staticmethod
+    def compile_rule(name, rule):
+        if rule == "change":
+            return name, None, None
+        return name, rule.get("absolute"), rule.get("percent")
+
+    def accept(self, device_id, subfolder, data, now):
+        """Whether the reading should be published."""
+        rules = self.rules.get(subfolder)
+        if rules is None:
+            return True
+        key = (device_id, subfolder)
+        self.seen[key] += 1
+        last = self.last.get(key)
+        if last is None or now - last[0] >= self.heartbeat_seconds or self.changed(rules, last[1], data):
+            self.last[key] = (now, data)
+            return True
+        self.suppressed[key] += 1
+        return False
+
+    @staticmethod
+    def changed(rules, previous, data):
+        for name, absolute, percent in rules:
+            if absolute is None and percent is None:
+                # Any change, also of str fields.
+                if data[name] != previous[name]:
+                    return True
+                continue
+            delta = abs(data[name] - previous[name])
+            if absolute is not None and delta > absolute:
+                return True
+            if percent is not None and delta > abs(previous[name]) * percent / 100:
+                return True
+        return False
+
+
+change_filter = None
+if publish_filters:
+    change_filter = ChangeFilter(publish_filters, publish_heartbeat_seconds)
+# [END iot_mqtt_filter]
+
+
+# [START iot_mqtt_aggregation]
+class WindowAggregator:
+    """Rolls the readings of each device into fixed, clock aligned windows.
+
+    The running min, max, sum and last value of every numeric field of a
+    device live side by side in one array('d'), four slots per field.
+    """
+
+    def __init__(self, window_seconds, schemas):
+        self.window_seconds = window_seconds
+        # device -> (subfolder, ((field, is_float), ...))
+        self.devices = {
+            schema.device_id: (schema.subfolder, tuple((name, convert is float) for name, convert in schema.fields
+                                                       if convert in (int, float)))
+            for schema in schemas}
+        # device -> [window start, reading count, accumulators]
+        self.windows = {}
+
+    def handles(self, device_id):
+        return device_id in self.devices
+
+    def add(self, device_id, data, now):
+        """Adds a reading taken at wall clock time now. Returns the summary
+        of the previous window if this reading starts a new one."""
+        start = now - now % self.window_seconds
+        window = self.windows.get(device_id)
+        closed = []
+        if window is not None and window[0] != start:
+            closed.append(self.summary(device_id, self.windows.pop(device_id)))
+            window = None
+        fields = self.devices[device_id][1]
+        if window is None:
+            window = self.windows[device_id] = [start, 0, array.array('d', (math.inf, -math.inf, 0, 0) * len(fields))]
+        accumulators = window[2]
+        for i, (name, _) in enumerate(fields):
+            value = data[name]
+            j = 4 * i
+            if value < accumulators[j]:
+                accumulators[j] = value
+            if value > accumulators[j + 1]:
+                accumulators[j + 1] = value
+            accumulators[j + 2] += value
+            accumulators[j + 3] = value
+        window[1] += 1
+        return closed
+
+    def due(self, now):
+        """Removes the windows that ended before now and returns their summaries."""
+        ended = [device_id for device_id, window in self.windows.items()
+                 if window[0] + self.window_seconds <= now]
+        return [self.summary(device_id, self.windows.pop(device_id)) for device_id in ended]
+
+    def summary(self, device_id, window):
+        start, count, accumulators = window
+        subfolder, fields = self.devices[device_id]
+        data = {"device_id": device_id}
+        for i, (name, is_float) in enumerate(fields):
+            j = 4 * i
+            convert = float if is_float else int
+            mean = accumulators[j + 2] / count
+            last = convert(accumulators[j + 3])
+            data[name] = mean if is_float else last
+            data[name + "_min"] = convert(accumulators[j])
+            data[name + "_max"] = convert(accumulators[j + 1])
+            data[name + "_mean"] = mean
+            data[name + "_last"] = last
+        data["count"] = count
+        data["timestamp"] = clock.format(int(start * 1000000000))
+        return device_id, subfolder, data
+
+
+aggregator = None
+if aggregate_window_seconds > 0:
+    aggregator = WindowAggregator(
+        aggregate_window_seconds,
+        [schema for schema in sensor_schemas.values() if schema.subfolder in aggregate_subfolders])
+# [END iot_mqtt_aggregation]
+
+
+# [START iot_mqtt_batching]
+class TelemetryBatcher:
+    """Collects readings per (device, subfolder) and releases them as one
+    batch once the window has elapsed or max_readings were collected."""
+
+    def __init__(self, window_seconds, max_readings):
+        self.window_seconds = window_seconds
+        self.max_readings = max_readings
+        # (device, subfolder) -> (time the batch was opened, readings)
+        self.batches = {}
+
+    def add(self, device_id, subfolder, data, now):
+        """Adds a reading and returns the batches that became full."""
+        key = (device_id, subfolder)
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = self.batches[key] = (now, [])
+        batch[1].append(data)
+        if len(batch[1]) >= self.max_readings:
+            del self.batches[key]
+            return [(device_id, subfolder, batch[1])]
+        return []
+
+    def due(self, now):
+        """Removes and returns the batches whose window has elapsed."""
+        expired = [key for key, (opened, _) in self.batches.items()
+                   if now - opened >= self.window_seconds]
+        return [key + (self.batches.pop(key)[1],) for key in expired]
+
+
+telemetry_batcher = None
+if batch_window_seconds > 0:
+    telemetry_batcher = TelemetryBatcher(batch_window_seconds, batch_max_readings)
+
+
+def publish_telemetry(client, device_id, subfolder, payload):
+    mqtt_topic = f"/devices/{device_id}/events/{subfolder}"
+    if outbox is not None:
+        outbox.append(mqtt_topic, payload)
+        return
+    if not attached_devices.ready(device_id):
+        attached_devices.hold(device_id, mqtt_topic, payload)
+        return
+    send_telemetry(client, mqtt_topic, payload)
+
+
+def publish_event(client, device_id, subfolder, data):
+    """Send a reading through aggregation and the change filter."""
+    if aggregator is not None and aggregator.handles(device_id):
+        for summary in aggregator.add(device_id, data, time.time()):
+            publish_reading(client, *summary)
+        if not aggregate_passthrough:
+            return
+    if change_filter is not None and not change_filter.accept(device_id, subfolder, data, time.monotonic()):
+        return
+    publish_reading(client, device_id, subfolder, data)
+
+
+def publish_reading(client, device_id, subfolder, data):
+    """Publish a reading right away, or hand it to the batcher."""
+    if telemetry_batcher is None:
+        payload = encoders.get(subfolder, default_encoder).encode(data)
+        return publish_telemetry(client, device_id, subfolder, payload)
+    for batch_device_id, batch_subfolder, readings in telemetry_batcher.add(
+            device_id, subfolder, data, time.monotonic()):
+        payload = encoders.get(batch_subfolder, default_encoder).encode_batch(readings)
+        publish_telemetry(client, batch_device_id, batch_subfolder, payload)
+
+
+def flush_pending(client):
+    """Publish the aggregation windows and batches that have elapsed."""
+    if aggregator is not None:
+        for summary in aggregator.due(time.time()):
+            publish_reading(client, *summary)
+    if telemetry_batcher is None:
+        return
+    for device_id, subfolder, readings in telemetry_batcher.due(time.monotonic()):
+        payload = encoders.get(subfolder, default_encoder).encode_batch(readings)
+        publish_telemetry(client, device_id, subfolder, payload)
+# [END iot_mqtt_batching]
+
+
+# [START iot_mqtt_store_forward]
+outbox = None
+
+
+def open_outbox():
+    global outbox
+    if store_forward_path:
+        outbox = store_forward.ReadingQueue(store_forward_path, store_forward_max_messages)
+        logger.info('Store-and-forward queue %s holds %s messages', store_forward_path, outbox.size)
+
+
+def drain_outbox(client):
+    """Publish the next queued messages, oldest first. Returns how many were
+    handed to paho."""
+    if outbox is None or not gateway_state.connected:
+        return 0
+    outbox.commit_acks()
+    if attached_devices.pending():
+        # Queued telemetry of a device being attached would be rejected.
+        return 0
+    limit = min(store_forward_drain_batch, inflight.free())
+    if limit == 0:
+        return 0
+    published = 0
+    for message_id, topic, payload in outbox.peek(limit, gateway_state.outbox_cursor):
+        if not send_telemetry(client, topic, payload, message_id):
+            break
+        gateway_state.outbox_cursor = message_id
+        published += 1
+    return published
+# [END iot_mqtt_store_forward]
+
+
+# [START iot_mqtt_metrics]
+def collect_metrics(writer, ports):
+    """Write the gateway statistics, read from the objects that keep them."""
+    readers = ports.readers
+    writer.counter('gateway_serial_frames_total', 'Frames read from the serial port.',
+                   [({'port': r.port}, r.frames_read) for r in readers])
+    writer.counter('gateway_serial_parse_errors_total', 'Frames that could not be parsed.',
+                   [({'port': r.port}, r.parse_errors) for r in readers])
+    writer.counter('gateway_serial_dropped_frames_total', 'Malformed or oversized frames dropped by the framer.',
+                   [({'port': r.port}, r.dropped_frames) for r in readers])
+    writer.counter('gateway_serial_overruns_total', 'Frames lost because the ring buffer was full.',
+                   [({'port': r.port}, r.overruns) for r in readers])
+    writer.counter('gateway_serial_read_errors_total', 'Serial read errors.',
+                   [({'port': r.port}, r.read_errors) for r in readers])
+    writer.gauge('gateway_serial_buffered_frames', 'Frames waiting in the ring buffer.',
+                 [({'port': r.port}, len(r.frames)) for r in readers])
+    writer.counter('gateway_serial_commands_total', 'Config and commands messages written to the port.',
+                   [({'port': r.port}, r.writer.written) for r in readers])
+    writer.counter('gateway_serial_write_errors_total', 'Messages that could not be written to the port.',
+                   [({'port': r.port}, r.writer.write_errors) for r in readers])
+    writer.histogram('gateway_command_latency_seconds', 'Time from receiving a message to writing it to the port.',
+                     SerialWriter.LATENCY_BUCKETS,
+                     [sum(counts) for counts in zip(*(r.writer.latency_counts for r in readers))],
+                     sum(r.writer.latency_sum for r in readers))
+
+    writer.counter('gateway_published_messages_total', 'Telemetry messages handed to paho.',
+                   [({'subfolder': subfolder}, count) for subfolder, count in list(published_messages.items())])
+    writer.histogram('gateway_publish_latency_seconds', 'Time from publish to on_publish.',
+                     inflight.LATENCY_BUCKETS, inflight.latency_counts, inflight.latency_sum)
+    writer.counter('gateway_publish_retransmits_total', 'QoS 0 messages published again after a timeout.',
+                   inflight.retransmits)
+    writer.counter('gateway_publish_timeouts_total', 'Messages without PUBACK after publish_timeout_seconds.',
+                   inflight.timeouts)
+    writer.gauge('gateway_pending_responses', 'Messages waiting for on_publish.',
+                 len(gateway_state.pending_responses))
+
+    writer.gauge('gateway_connected', '1 while connected to the MQTT bridge.', int(gateway_state.connected))
+    writer.gauge('gateway_devices', 'Devices the sensor nodes asked to attach.', len(attached_devices.devices))
+    writer.gauge('gateway_attached_devices', 'Devices attached on the current connection.',
+                 len(attached_devices.attached))
+    writer.gauge('gateway_held_messages', 'Telemetry held until the attach of its device is acknowledged.',
+                 sum(len(held) for held in list(attached_devices.held.values())))
+    writer.counter('gateway_duplicate_attach_requests_total', 'Attach and detach requests that changed nothing.',
+                   attached_devices.duplicates)
+    writer.counter('gateway_held_messages_dropped_total', 'Held telemetry dropped.', attached_devices.dropped)
+    if supervisor is not None:
+        writer.counter('gateway_reconnects_total', 'Successful reconnections.', supervisor.reconnects)
+        writer.counter('gateway_failed_reconnects_total', 'Failed reconnection attempts.',
+                       supervisor.failed_reconnects)
+        writer.counter('gateway_token_rotations_total', 'Reconnections to rotate the JWT.',
+                       supervisor.token_rotations)
+        writer.counter('gateway_downtime_seconds_total', 'Time spent disconnected.', supervisor.downtime_seconds())
+        writer.gauge('gateway_jwt_age_seconds', 'Age of the JWT in use.', supervisor.token_age())
+
+    if change_filter is not None:
+        writer.counter('gateway_filter_seen_total', 'Readings checked by the change filter.',
+                       [({'device': device, 'subfolder': subfolder}, count)
+                        for (device, subfolder), count in list(change_filter.seen.items())])
+        writer.counter('gateway_filter_suppressed_total', 'Readings dropped by the change filter.',
+                       [({'device': device, 'subfolder': subfolder}, count)
+                        for (device, subfolder), count in list(change_filter.suppressed.items())])
+    if outbox is not None:
+        writer.gauge('gateway_outbox_messages', 'Messages in the store-and-forward queue.', outbox.size)
+        writer.counter('gateway_outbox_dropped_total', 'Messages dropped from the full queue.', outbox.dropped)
+
+
+def start_metrics_server(ports):
+    if not metrics_port:
+        return None
+    server = metrics.MetricsServer(metrics_port, lambda writer: collect_metrics(writer, ports), metrics_host)
+    server.start()
+    logger.info('Serving metrics on http://%s:%s/metrics', metrics_host, server.port)
+    return server
+# [END iot_mqtt_metrics]
+
+
 # [START iot_mqtt_run]
+def process_serial_data(client, reader, captured, serial_data):
+    """Parse one frame from the Arduino on reader's port, read at monotonic
+    time captured, and act on it."""
+    if serial_protocol == 'binary':
+        command = parse_binary_frame(serial_data, captured)
+    else:
+        command = parse_sensors_data(serial_data, captured)
+    if not command:
+        reader.parse_errors += 1
+        logger.warning('invalid json command %s', serial_data)
+        return
+    action = command["action"]
+    device_id = command["device"]
+    if device_id is None:
+        reader.parse_errors += 1
+        logger.warning('Unrecognized sensor node ID')
+        return
+    template = '{{ "device": "{}", "command": "{}", "status" : "ok" }}'
+    if action == 'event':
+        logger.debug('Sending telemetry event for device %s', device_id)
+        publish_event(client, device_id, command['subfolder'], command["data"])
+        #response = template.format(device_id, 'event')
+        #gateway_state.pending_responses[event_mid] = (client_addr, response)
+    elif action == 'attach':
+        attach_mid = attached_devices.attach(client, device_id)
+        response = template.format(device_id, 'attach')
+        logger.debug('Save mid %s for response %s', attach_mid, response)
+        #gateway_state.pending_responses[attach_mid] = (client_addr, response)
+    elif action == 'detach':
+        detach_mid = attached_devices.detach(client, device_id)
+        topics = command_router.remove(device_id)
+        if topics and gateway_state.connected:
+            client.unsubscribe(topics)
+        response = template.format(device_id, 'detach')
+        logger.debug('Save mid %s for response %s', detach_mid, response)
+        #gateway_state.pending_responses[detach_mid] = (client_addr, response)
+    elif action == "subscribe":
+        logger.info('subscribe config and commands for %s', device_id)
+        _, mid = subscribe_device(client, reader, command["node"], device_id)
+        response = template.format(device_id, 'subscribe')
+        logger.debug('Save mid %s for response %s', mid, response)
+        #gateway_state.pending_subscribes[mid] = (client_addr, response)
+    else:
+        logger.warning('undefined action: %s', action)
+
+
+def run_loop(client, ports):
+    """Blocking runtime: alternate paho's loop with frames from the reader
+    threads."""
+    for reader in ports.readers:
+        reader.start()
+
+    while True:
+        # Frames that publish nothing do not wake paho's select, do not wait
+        # in it while some are buffered.
+        busy = gateway_state.connected and ports.has_frames() and not (inflight.full() and outbox is None)
+        client.loop(timeout=0 if busy else 0.01)
+        next_poll = supervisor.poll()
+        # Without a store-and-forward queue, readings wait in the serial
+        # ring buffer while disconnected. Keep running paho's loop while a
+        # CONNACK is awaited, only sleep until the next attempt.
+        if gateway_state.connected is False and outbox is None:
+            logger.debug('connect status %s', gateway_state.connected)
+            if not supervisor.connecting():
+                time.sleep(min(next_poll, 1))
+            continue
+
+        retransmit_expired(client)
+        if inflight.full() and outbox is None:
+            # Backpressure: readings wait in the serial ring buffer until
+            # PUBACKs free the window.
+            continue
+
+        # Messages for the sensor nodes wait in the socket while this
+        # blocks, keep it short once there are subscriptions. Then take what
+        # is already buffered, up to serial_frames_per_loop frames.
+        timeout = 0.01 if gateway_state.subscriptions else 0.1
+        for _ in range(serial_frames_per_loop):
+            item = read_serial_data(ports, timeout)
+            if item is not None:
+                process_serial_data(client, *item)
+            if not ports.has_frames() or (inflight.full() and outbox is None):
+                break
+            timeout = 0
+        flush_pending(client)
+        drain_outbox(client)
+
+
+class AsyncioHelper:
+    """Registers the paho client socket on an asyncio event loop, so that
+    loop_read/loop_write run when the socket is ready instead of polling."""
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        self.thread = threading.get_ident()
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+        # get_client() already connected, pick up the socket it opened.
+        sock = client.socket()
+        if sock is not None:
+            self.on_socket_open(client, None, sock)
+            if client.want_write():
+                self.on_socket_register_write(client, None, sock)
+
+    def call(self, callback, *args):
+        """Run callback on the loop. paho calls the socket callbacks from the
+        thread that runs reconnect(), an executor thread of the supervisor."""
+        if threading.get_ident() == self.thread:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self.call(self.watch, client, sock)
+
+    def watch(self, client, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        if self.misc is None or self.misc.done():
+            self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        # paho closes the socket right after, unregister its descriptor.
+        self.call(self.unwatch, sock.fileno())
+
+    def unwatch(self, fd):
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.call(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.call(self.loop.remove_writer, sock)
+
+    async def misc_loop(self):
+        # Keepalive pings and retries, paho wants this about once a second.
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+async def supervisor_task(wakeup):
+    """Run the connection supervisor when it is due or on a disconnect. The
+    reconnects themselves block on DNS, TCP and TLS, so they run in the
+    default executor and the serial path keeps going meanwhile."""
+    loop = asyncio.get_running_loop()
+    while True:
+        reconnect_due, delay = supervisor.schedule()
+        if reconnect_due:
+            await loop.run_in_executor(None, supervisor.reconnect)
+            continue
+        try:
+            await asyncio.wait_for(wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
+
+
+async def flush_task(client, connected, outbox_ready):
+    """Publish aggregation windows and batches as they elapse."""
+    while True:
+        await asyncio.sleep(min(batch_window_seconds or 1, 1))
+        if outbox is None:
+            await connected.wait()
+        flush_pending(client)
+        outbox_ready.set()
+
+
+async def retransmit_task(client):
+    """Publish again the messages that got no PUBACK in time."""
+    while True:
+        await asyncio.sleep(1)
+        retransmit_expired(client)
+
+
+async def outbox_task(client, outbox_ready):
+    """Upload queued messages whenever new ones arrive or the client
+    reconnects."""
+    while True:
+        await outbox_ready.wait()
+        outbox_ready.clear()
+        while drain_outbox(client):
+            await asyncio.sleep(0)
+
+
+async def serial_port_task(reader, frames_ready):
+    """Feed reader from its port while it is readable, and open the port
+    again whenever it fails."""
+    loop = asyncio.get_running_loop()
+    while True:
+        # Opening resets the Arduino and takes a second, keep it off the loop.
+        if not await loop.run_in_executor(None, reader.open):
+            await asyncio.sleep(serial_reopen_seconds)
+            continue
+        ser = reader.ser
+        failed = loop.create_future()
+
+        def on_serial_readable():
+            try:
+                data = ser.read(ser.in_waiting or 1)
+            except OSError as e:
+                reader.read_errors += 1
+                logger.error('Serial read error on %s: %s', reader.port, e)
+                loop.remove_reader(ser.fileno())
+                failed.set_result(None)
+                return
+            reader.feed(data)
+            if reader.frames:
+                frames_ready.set()
+
+        loop.add_reader(ser.fileno(), on_serial_readable)
+        try:
+            await failed
+        finally:
+            if not failed.done():
+                loop.remove_reader(ser.fileno())
+            reader.close()
+
+
+async def run_asyncio(client, ports):
+    """Event loop runtime: the MQTT socket and the serial ports share one
+    selector, so neither side waits on the other. Needs serial ports that
+    expose a file descriptor (POSIX)."""
+    loop = asyncio.get_running_loop()
+    frames_ready = asyncio.Event()
+    connected = asyncio.Event()
+    disconnected = asyncio.Event()
+    outbox_ready = asyncio.Event()
+    window_open = asyncio.Event()
+
+    def on_publish_async(client, userdata, mid):
+        on_publish(client, userdata, mid)
+        if not inflight.full():
+            window_open.set()
+            outbox_ready.set()
+
+    def on_connect_async(client, userdata, flags, rc):
+        on_connect(client, userdata, flags, rc)
+        if gateway_state.connected:
+            connected.set()
+            outbox_ready.set()
+
+    def on_disconnect_async(client, userdata, rc):
+        on_disconnect(client, userdata, rc)
+        connected.clear()
+        disconnected.set()
+
+    client.on_connect = on_connect_async
+    client.on_disconnect = on_disconnect_async
+    client.on_publish = on_publish_async
+    AsyncioHelper(loop, client)
+    tasks = [loop.create_task(supervisor_task(disconnected)),
+             loop.create_task(retransmit_task(client))]
+    tasks.extend(loop.create_task(serial_port_task(reader, frames_ready)) for reader in ports.readers)
+    if telemetry_batcher is not None or aggregator is not None:
+        tasks.append(loop.create_task(flush_task(client, connected, outbox_ready)))
+    if outbox is not None:
+        tasks.append(loop.create_task(outbox_task(client, outbox_ready)))
+
+    try:
+        while True:
+            await frames_ready.wait()
+            frames_ready.clear()
+            # Without a store-and-forward queue, frames wait in the ring
+            # buffer while the bridge is unreachable.
+            if outbox is None:
+                await connected.wait()
+            while gateway_state.connected or outbox is not None:
+                if inflight.full() and outbox is None:
+                    # Backpressure: readings wait in the serial ring buffer
+                    # until PUBACKs free the window.
+                    window_open.clear()
+                    await window_open.wait()
+                    continue
+                item = read_serial_data(ports, timeout=0)
+                if item is None:
+                    break
+                process_serial_data(client, *item)
+                # Let socket events in between frames of a burst.
+                await asyncio.sleep(0)
+            outbox_ready.set()
+            if ports.has_frames():
+                frames_ready.set()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
 def main():
     global gateway_state
+    setup_logging()
     gateway_state.mqtt_config_topic = f"/devices/{gateway_id}/config"
     gateway_state.mqtt_bridge_hostname = mqtt_bridge_hostname
     gateway_state.mqtt_bridge_port = mqtt_bridge_port
@@ -302,54 +1934,20 @@ def main():
     client = get_client(project_id, cloud_region, registry_id, gateway_id, private_key_file, algorithm, ca_certs,
                         mqtt_bridge_hostname, mqtt_bridge_port, jwt_expires_minutes)
 
-    ser = init_serial(serial_port)
+    client.max_inflight_messages_set(inflight_window)
+    start_supervisor(client)
+    open_outbox()
+    ports = create_serial_ports()
+    start_metrics_server(ports)
 
-    while True:
-        client.loop()
-        if gateway_state.connected is False:
-            print('connect status {}'.format(gateway_state.connected))
-            time.sleep(1)
-            continue
-
-        serial_data = read_serial_data(ser)
-        command = parse_sensors_data(serial_data)
-        if not command:
-            print(f"invalid json command {serial_data}")
-            continue
-        action = command["action"]
-        device_id = command["device"]
-        template = '{{ "device": "{}", "command": "{}", "status" : "ok" }}'
-        if action == 'event':
-            print(f"Sending telemetry event for device {device_id}")
-            payload = json.dumps(command["data"])
-            mqtt_topic = f"/devices/{device_id}/events/{command['subfolder']}"
-            print('Publishing message to topic {} with payload \'{}\''.format(mqtt_topic, payload))
-            _, event_mid = client.publish(mqtt_topic, payload, qos=0)
-            #response = template.format(device_id, 'event')
-            #print('Save mid {} for response {}'.format(event_mid, response))
-            #gateway_state.pending_responses[event_mid] = (client_addr, response)
-        elif action == 'attach':
-            _, attach_mid = attach_device(client, device_id)
-            response = template.format(device_id, 'attach')
-            print('Save mid {} for response {}'.format(attach_mid, response))
-            #gateway_state.pending_responses[attach_mid] = (client_addr, response)
-        elif action == 'detach':
-            _, detach_mid = detatch_device(client, device_id)
-            response = template.format(device_id, 'detach')
-            print('Save mid {} for response {}'.format(detach_mid, response))
-            #gateway_state.pending_responses[detach_mid] = (client_addr, response)
-        elif action == "subscribe":
-            print('subscribe config for {}'.format(device_id))
-            subscribe_topic = '/devices/{}/config'.format(device_id)
-            _, mid = client.subscribe(subscribe_topic, qos=1)
-            response = template.format(device_id, 'subscribe')
-            #gateway_state.subscriptions[subscribe_topic] = (client_addr)
-            print('Save mid {} for response {}'.format(mid, response))
-            #gateway_state.pending_subscribes[mid] = (client_addr, response)
+    try:
+        if gateway_runtime == 'asyncio':
+            asyncio.run(run_asyncio(client, ports))
         else:
-            print('undefined action: {}'.format(action))
-
-    print('Finished.')
+            run_loop(client, ports)
+        logger.info('Finished.')
+    finally:
+        stop_logging()
 # [END iot_mqtt_run]
 
 
@@ -0,0 +1,232 @@
+"""
+Micro-benchmarks of the gateway per-frame path: parsing ASCII and binary
+frames, encoding the event payload, building the topic, and the whole
+process_serial_data() with a client that drops what it is given. Each
+payload encoding is measured too.
+
+The frame streams mix valid readings of both nodes, attach/detach commands,
+malformed values and unknown nodes. Results are written as JSON; given a
+baseline produced the same way, the run fails if any benchmark lost more
+than --threshold of its throughput.
+
+Usage example:
+
+    python gateway_benchmark.py --output baseline.json
+    python gateway_benchmark.py --baseline baseline.json --threshold 0.15
+"""
+
+import argparse
+import json
+import logging
+import platform
+import random
+import sys
+import time
+
+import paho.mqtt.client as mqtt
+
+import gateway
+import payload_encoders
+import serial_frames
+
+STREAM_SIZE = 1000
+
+
+def ascii_stream(size, seed=0):
+    """Lines as read from the Arduino: mostly readings, some commands and
+    some garbage."""
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(size):
+        kind = rng.random()
+        if kind < 0.45:
+            lines.append('#1,{}'.format(rng.randint(0, 1)))
+        elif kind < 0.9:
+            lines.append('#2,{:.1f},{:.1f},{}'.format(rng.uniform(20, 90), rng.uniform(15, 35), rng.randint(0, 3)))
+        elif kind < 0.95:
+            lines.append('#{},{}'.format(rng.choice(('attach', 'detach')), rng.choice('12')))
+        elif kind < 0.98:
+            lines.append('#2,{:.1f},oops'.format(rng.uniform(20, 90)))
+        else:
+            lines.append('#7,1')
+    return lines
+
+
+def binary_stream(size, seed=0):
+    rng = random.Random(seed)
+    frames = []
+    for _ in range(size):
+        kind = rng.random()
+        if kind < 0.45:
+            frames.append(serial_frames.encode_frame(serial_frames.CANAL_CLEANER, rng.randint(0, 1)))
+        elif kind < 0.9:
+            frames.append(serial_frames.encode_frame(serial_frames.WEATHER_STATION, rng.uniform(20, 90),
+                                                     rng.uniform(15, 35), rng.randint(0, 3)))
+        else:
+            frames.append(serial_frames.encode_frame(
+                rng.choice((serial_frames.ATTACH, serial_frames.DETACH)), rng.randint(1, 2)))
+    return b''.join(frames)
+
+
+class NullClient:
+    """Takes publishes like paho on a connected client: QoS 0 messages are
+    written right away, QoS 1 ones (the attaches) wait for a PUBACK that
+    deliver_pubacks() plays through gateway.on_publish."""
+
+    def __init__(self):
+        self.mid = 0
+        self.unacked = []
+
+    def publish(self, topic, payload=None, qos=0):
+        self.mid += 1
+        info = mqtt.MQTTMessageInfo(self.mid)
+        if qos:
+            self.unacked.append(self.mid)
+        else:
+            info._published = True
+        return info
+
+    def deliver_pubacks(self):
+        unacked, self.unacked = self.unacked, []
+        for mid in unacked:
+            gateway.on_publish(self, None, mid)
+
+    def subscribe(self, topic, qos=0):
+        self.mid += 1
+        return mqtt.MQTT_ERR_SUCCESS, self.mid
+
+
+def bench_parse_ascii(lines):
+    for line in lines:
+        gateway.parse_sensors_data(line)
+
+
+def bench_parse_binary(data):
+    framer = serial_frames.BinaryFramer()
+    for frame in framer.feed(data):
+        gateway.parse_binary_frame(frame)
+
+
+def bench_encode_json(events):
+    for event in events:
+        json.dumps(event)
+
+
+def bench_encode(commands, encoders):
+    for command in commands:
+        encoders[command['subfolder']].encode(command['data'])
+
+
+def bench_topic(commands):
+    for command in commands:
+        f"/devices/{command['device']}/events/{command['subfolder']}"
+
+
+def bench_process_ascii(lines, client):
+    class Reader:
+        parse_errors = 0
+    reader = Reader()
+    # Every run starts with no device attached, and attaches are acknowledged
+    # before the next line, so that readings take the publish path and are
+    # not held.
+    gateway.attached_devices = gateway.AttachedDevices(gateway.serial_buffer_frames)
+    gateway.inflight.messages.clear()
+    for line in lines:
+        gateway.process_serial_data(client, reader, None, line)
+        if client.unacked:
+            client.deliver_pubacks()
+
+
+def measure(function, args, frames, repeat, min_seconds):
+    """Best frames per second of function(*args) over repeat runs of at
+    least min_seconds each."""
+    best = 0.0
+    for _ in range(repeat):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            function(*args)
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_seconds:
+                break
+        best = max(best, calls * frames / elapsed)
+    return best
+
+
+def run_benchmarks(repeat, min_seconds):
+    lines = ascii_stream(STREAM_SIZE)
+    data = binary_stream(STREAM_SIZE)
+    commands = [command for command in map(gateway.parse_sensors_data, lines)
+                if command and command['action'] == 'event']
+    events = [command['data'] for command in commands]
+    benchmarks = {
+        'parse_ascii': (bench_parse_ascii, (lines,), len(lines)),
+        'parse_binary': (bench_parse_binary, (data,), STREAM_SIZE),
+        'encode_json': (bench_encode_json, (events,), len(events)),
+        'topic': (bench_topic, (commands,), len(commands)),
+        'process_ascii': (bench_process_ascii, (lines, NullClient()), len(lines)),
+    }
+    timestamp_type = int if gateway.timestamp_format == 'epoch_ms' else str
+    for encoding in payload_encoders.ENCODERS:
+        encoders = {schema.subfolder: payload_encoders.create_encoder(encoding, schema.fields, timestamp_type)
+                    for schema in gateway.sensor_schemas.values()}
+        benchmarks['encode_' + encoding] = (bench_encode, (commands, encoders), len(commands))
+    results = {}
+    for name, (function, args, frames) in benchmarks.items():
+        frames_per_second = measure(function, args, frames, repeat, min_seconds)
+        results[name] = {'frames_per_second': frames_per_second, 'ns_per_frame': 1e9 / frames_per_second}
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Returns the benchmarks that regressed by more than threshold."""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        change = result['frames_per_second'] / previous['frames_per_second'] - 1
+        if change < -threshold:
+            regressions.append((name, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per benchmark, the best one counts.')
+    parser.add_argument('--min-seconds', type=float, default=0.2, help='Minimum duration of a run.')
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', help='JSON results to compare with.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Fraction of throughput a benchmark may lose against the baseline.')
+    args = parser.parse_args()
+
+    # Malformed frames are logged; keep that out of the measurements.
+    gateway.logger.setLevel(logging.CRITICAL)
+    gateway.change_filter = gateway.aggregator = gateway.telemetry_batcher = gateway.outbox = None
+    gateway.gateway_state.connected = True
+
+    results = run_benchmarks(args.repeat, args.min_seconds)
+    for name, result in results.items():
+        print('{:<20} {:>12.0f} frames/s {:>9.0f} ns/frame'.format(
+            name, result['frames_per_second'], result['ns_per_frame']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                       'benchmarks': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['benchmarks']
+        regressions = compare(results, baseline, args.threshold)
+        for name, change in regressions:
+            print('REGRESSION {}: {:+.1%} frames/s'.format(name, change))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -61,31 +61,26 @@ def registry_summary():
 
 def list_devices():
     print("############################## DEVICES #######################################")
-    devices = manager.list_devices(service_account_json, project_id, cloud_region, registry_id)
-    if not devices:
-        print("No device found!")
-        print("############################### GATEWAYS #######################################")
-        print("No gateway found!")
-        return
-    i = 1
-    gateways = []
+    devices = manager.iter_devices(service_account_json, project_id, cloud_region, registry_id, projection="health",
+                                   gateway_type=iot_v1.GatewayType.NON_GATEWAY)
+    found = False
     for device in devices:
-        if device.gateway_config.gateway_type.name == "GATEWAY":
-            gateways.append(device)
-        else:
-            print(f"{device.id}")
-            print(f"\t- name : {device.name}")
-            print(f"\t- auth method : {get_auth_method(device.gateway_config.gateway_auth_method)}")
-            print(f"\t- last event : {device.last_event_time}")
-            print(f"\t- last error : '{device.last_error_status.message}'")
-            i += 1
-    # Gateways info
+        found = True
+        print(f"{device.id}")
+        print(f"\t- name : {device.name}")
+        print(f"\t- auth method : {get_auth_method(device.gateway_config.gateway_auth_method)}")
+        print(f"\t- last event : {device.last_event_time}")
+        print(f"\t- last error : '{device.last_error_status.message}'")
+    if not found:
+        print("No device found!")
+    # Gateways info, with their credentials but without config and state
     print("############################### GATEWAYS #######################################")
-    if not gateways:
-        print("No gateway found!")
-        return
-    i = 1
+    gateways = manager.iter_devices(service_account_json, project_id, cloud_region, registry_id,
+                                    projection=manager.DEVICE_PROJECTIONS["health"] + ["credentials"],
+                                    gateway_type=iot_v1.GatewayType.GATEWAY)
+    found = False
     for gateway in gateways:
+        found = True
         print(f"{gateway.id}")
         print(f"\t- name : {gateway.name}")
         print(f"\t- auth method : {get_auth_method(gateway.gateway_config.gateway_auth_method)}")
@@ -93,14 +88,17 @@ def list_devices():
         print(f"\t- last heartbeat : {gateway.last_heartbeat_time}")
         print(f"\t- last error : '{gateway.last_error_status.message}'")
         # Bound devices
-        bound_devices = manager.list_devices_for_gateway(service_account_json, project_id, cloud_region, registry_id,
-                                                         gateway.id)
+        bound_devices = manager.iter_devices(service_account_json, project_id, cloud_region, registry_id,
+                                             projection="ids", gateway_id=gateway.id)
         print(f"\t- bound devices :")
-        if not devices:
+        bound = False
+        for device in bound_devices:
+            bound = True
+            print(f"\t\t* {device.id}")
+        if not bound:
             print(f"\t\t* No device!")
-        else :
-            for device in bound_devices:
-                print(f"\t\t* {device.id}")
+    if not found:
+        print("No gateway found!")
 
 
 def list_pubsub_topics():
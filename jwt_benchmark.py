@@ -0,0 +1,63 @@
+"""
+Micro-benchmark of the JWT signing done by the gateway on every (re)connect.
+
+Compares RS256 and ES256, each with the key parsed from PEM on every token
+(what create_jwt used to do) and with the key parsed once.
+
+Usage example:
+
+    python jwt_benchmark.py --rounds 50
+"""
+
+import argparse
+import datetime
+import time
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+
+def generate_pem(algorithm):
+    if algorithm == 'RS256':
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    else:
+        key = ec.generate_private_key(ec.SECP256R1())
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+
+
+def claims():
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    return {'iat': now, 'exp': now + datetime.timedelta(minutes=20), 'aud': 'benchmark'}
+
+
+def time_per_call(function, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function()
+    return 1000 * (time.perf_counter() - start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=50, help='Tokens signed per measurement.')
+    args = parser.parse_args()
+
+    for algorithm in ('RS256', 'ES256'):
+        pem = generate_pem(algorithm)
+        key = serialization.load_pem_private_key(pem, password=None)
+        parse_and_sign = time_per_call(lambda: jwt.encode(claims(), pem, algorithm=algorithm), args.rounds)
+        sign = time_per_call(lambda: jwt.encode(claims(), key, algorithm=algorithm), args.rounds)
+        print('{}:'.format(algorithm))
+        print('\tparse PEM + sign : {:.2f} ms'.format(parse_and_sign))
+        print('\tsign with parsed key : {:.2f} ms'.format(sign))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+End-to-end load test of gateway.py, fully offline.
+
+Runs the gateway as a subprocess against a virtual Arduino (virtual_arduino.py)
+and a local broker (fake_broker.py) that checks its JWT and TLS connection.
+Readings are sent in stages of increasing rate, each reading tagged with a
+sequence number, and the time from the serial write to the PUBACK is
+measured for each one. A stage is sustained when nearly all its readings
+arrive with a bounded p99 latency; the test stops at the first stage that
+is not.
+
+Usage example:
+
+    python load_test.py --start-rate 100 --max-rate 6400 --stage-seconds 5 --jitter 0.3
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import fake_broker
+from virtual_arduino import VirtualArduino
+
+PROJECT_ID = 'load-test'
+
+
+# Payload encodings the Receiver decodes, see payload_encodings in gateway.py
+DECODED_ENCODINGS = {'json', 'json_template'}
+
+
+class Receiver:
+    """Records when the broker wrote out the PUBACK of each sequence number
+    (received it, at QoS 0). Payloads must be JSON."""
+
+    def __init__(self):
+        self.received = {}
+
+    def on_acked(self, topic, payload):
+        now = time.perf_counter()
+        if not payload:
+            return
+        readings = json.loads(payload)
+        if isinstance(readings, dict):
+            readings = [readings]
+        for reading in readings:
+            seq = reading.get('obstruction', reading.get('humidity'))
+            if seq is not None:
+                self.received.setdefault(int(seq), now)
+
+
+def write_device_key(directory):
+    """Writes rsa_private.pem, as the gateway expects it, and returns the
+    public key."""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    with open(os.path.join(directory, 'rsa_private.pem'), 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return key.public_key()
+
+
+def start_broker(directory, public_key, receiver):
+    """Runs a FakeBroker on its own event loop thread."""
+    _, cert_file, key_file = fake_broker.write_tls_files(directory)
+    loop = asyncio.new_event_loop()
+    broker = fake_broker.FakeBroker(fake_broker.server_ssl_context(cert_file, key_file), public_key,
+                                    PROJECT_ID, on_acked=receiver.on_acked)
+    loop.run_until_complete(broker.start())
+    threading.Thread(target=loop.run_forever, name='broker', daemon=True).start()
+    return loop, broker
+
+
+def stop_broker(loop, broker):
+    asyncio.run_coroutine_threadsafe(broker.close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def read_gateway_config(args):
+    """The extra gateway config keys of --gateway-config."""
+    if not args.gateway_config:
+        return {}
+    with open(args.gateway_config) as f:
+        return json.load(f)
+
+
+def start_gateway(directory, serial_port, broker_port, args):
+    config = {
+        'my_id': 'load-test',
+        'project_id': PROJECT_ID,
+        'service_account_json': 'unused.json',
+        'cloud_region': 'us-central1',
+        'serial_port': serial_port,
+        'mqtt_bridge_hostname': 'localhost',
+        'mqtt_bridge_port': broker_port,
+        'gateway_runtime': args.runtime,
+        'telemetry_qos': 1,
+        'log_level': 'WARNING',
+    }
+    config.update(read_gateway_config(args))
+    with open(os.path.join(directory, 'config.json'), 'w') as f:
+        json.dump(config, f)
+    gateway = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gateway.py')
+    return subprocess.Popen([sys.executable, gateway], cwd=directory,
+                            stdout=None if args.verbose else subprocess.DEVNULL)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_stage(arduino, receiver, rate, args, first_seq):
+    start = time.perf_counter()
+    end_seq = arduino.send_stream(rate, args.stage_seconds, args.jitter, first_seq)
+    sent = end_seq - first_seq
+    deadline = time.perf_counter() + args.drain_seconds
+    while time.perf_counter() < deadline:
+        if all(seq in receiver.received for seq in range(first_seq, end_seq)):
+            break
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    latencies = sorted(receiver.received[seq] - arduino.sent[seq]
+                       for seq in range(first_seq, end_seq) if seq in receiver.received)
+    stage = {'rate': rate, 'sent': sent, 'delivered': len(latencies),
+             'throughput': len(latencies) / elapsed}
+    if latencies:
+        stage.update(p50=percentile(latencies, 0.5), p99=percentile(latencies, 0.99), max=latencies[-1])
+    stage['sustained'] = (bool(latencies) and len(latencies) >= args.min_delivery * sent
+                          and stage['p99'] <= args.max_p99)
+    return stage, end_seq
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--start-rate', type=float, default=100, help='Readings per second of the first stage.')
+    parser.add_argument('--max-rate', type=float, default=6400, help='Rate of the last stage.')
+    parser.add_argument('--rate-factor', type=float, default=2, help='Rate increase between stages.')
+    parser.add_argument('--stage-seconds', type=float, default=5, help='Duration of each stage.')
+    parser.add_argument('--drain-seconds', type=float, default=3,
+                        help='Time given to the last readings of a stage to arrive.')
+    parser.add_argument('--jitter', type=float, default=0.2,
+                        help='Fraction by which each interval between readings varies.')
+    parser.add_argument('--min-delivery', type=float, default=0.99,
+                        help='Fraction of the readings a sustained stage delivers.')
+    parser.add_argument('--max-p99', type=float, default=1.0,
+                        help='p99 serial to PUBACK latency of a sustained stage, in seconds.')
+    parser.add_argument('--runtime', choices=('loop', 'asyncio'), default='loop', help='Gateway runtime.')
+    parser.add_argument('--gateway-config', help='JSON file of extra gateway config keys.')
+    parser.add_argument('--verbose', action='store_true', help='Show the gateway output.')
+    args = parser.parse_args()
+    encodings = set(read_gateway_config(args).get('payload_encodings', {}).values()) - DECODED_ENCODINGS
+    if encodings:
+        parser.error('the load test only decodes JSON payloads, not {}'.format(', '.join(sorted(encodings))))
+
+    with tempfile.TemporaryDirectory() as directory:
+        receiver = Receiver()
+        loop, broker = start_broker(directory, write_device_key(directory), receiver)
+        arduino = VirtualArduino()
+        gateway = start_gateway(directory, arduino.port, broker.port, args)
+        try:
+            # Opening the port flushes what was written before, so attach
+            # until the gateway is seen reading.
+            deadline = time.perf_counter() + 30
+            while not any(topic.endswith('/attach') for topic in list(broker.publishes)):
+                if gateway.poll() is not None or time.perf_counter() > deadline:
+                    sys.exit('The gateway did not connect to the broker')
+                if broker.connects:
+                    arduino.attach()
+                time.sleep(0.5)
+
+            best = None
+            seq = 0
+            rate = args.start_rate
+            print('{:>8} {:>7} {:>9} {:>10} {:>9} {:>9} {:>9}'.format(
+                'rate', 'sent', 'delivered', 'readings/s', 'p50 ms', 'p99 ms', 'max ms'))
+            while rate <= args.max_rate:
+                stage, seq = run_stage(arduino, receiver, rate, args, seq)
+                print('{rate:>8.0f} {sent:>7} {delivered:>9} {throughput:>10.0f} {p50:>9.2f} {p99:>9.2f} {max:>9.2f}'
+                      .format(**dict(stage, p50=1000 * stage.get('p50', 0), p99=1000 * stage.get('p99', 0),
+                                     max=1000 * stage.get('max', 0))))
+                if not stage['sustained']:
+                    break
+                best = stage
+                rate *= args.rate_factor
+            arduino.detach()
+        finally:
+            gateway.terminate()
+            gateway.wait()
+            stop_broker(loop, broker)
+            arduino.close()
+
+    print('broker: {} connects, {} rejected'.format(broker.connects, broker.rejected_connects))
+    if best is None:
+        print('max sustainable rate: below {:.0f} readings/s'.format(args.start_rate))
+    else:
+        print('max sustainable rate: {:.0f} readings/s (p50 {:.2f} ms, p99 {:.2f} ms)'.format(
+            best['rate'], 1000 * best['p50'], 1000 * best['p99']))
+
+
+if __name__ == '__main__':
+    main()
@@ -29,12 +29,19 @@ Usage example:
 """
 
 import argparse
+import concurrent.futures
 import io
+import json
 import os
+import random
 import sys
+import threading
 import time
 
 from google.api_core.exceptions import AlreadyExists
+from google.api_core.exceptions import GoogleAPICallError
+from google.api_core.exceptions import ResourceExhausted
+from google.api_core.exceptions import ServiceUnavailable
 from google.cloud import iot_v1
 from google.cloud import pubsub
 from google.oauth2 import service_account
@@ -42,6 +49,8 @@ from google.protobuf import field_mask_pb2 as gp_field_mask
 from googleapiclient import discovery
 from googleapiclient.errors import HttpError
 
+import registry_mirror
+
 
 def create_iot_topic(project, topic_name):
     """Creates a PubSub Topic and grants access to Cloud IoT Core."""
@@ -61,6 +70,47 @@ def create_iot_topic(project, topic_name):
     return topic
 
 
+# DeviceManagerClient shared by all the calls with the same credentials and
+# region, see get_device_manager().
+_device_managers = {}
+_device_managers_lock = threading.Lock()
+
+
+def get_device_manager(service_account_json, cloud_region):
+    """Returns the DeviceManagerClient for these credentials and region,
+    created on first use and reused afterwards, so that credentials, gRPC
+    channel and TLS session are set up once per process. Clients are thread
+    safe. Without a service account file the default credentials are used."""
+    key = (service_account_json, cloud_region)
+    client = _device_managers.get(key)
+    if client is None:
+        with _device_managers_lock:
+            client = _device_managers.get(key)
+            if client is None:
+                if service_account_json and os.path.exists(service_account_json):
+                    client = iot_v1.DeviceManagerClient.from_service_account_file(service_account_json)
+                else:
+                    client = iot_v1.DeviceManagerClient()
+                _device_managers[key] = client
+    return client
+
+
+def set_device_manager(service_account_json, cloud_region, client):
+    """Makes get_device_manager() return client for these credentials and
+    region, e.g. a fake_device_manager.FakeDeviceManager."""
+    with _device_managers_lock:
+        _device_managers[(service_account_json, cloud_region)] = client
+
+
+def close_clients():
+    """Closes the channels of the shared DeviceManagerClients."""
+    with _device_managers_lock:
+        clients = list(_device_managers.values())
+        _device_managers.clear()
+    for client in clients:
+        client.transport.close()
+
+
 def get_client(service_account_json):
     """Returns an authorized API client by discovering the IoT API and creating
     a service object using the service account credentials JSON."""
@@ -101,7 +151,7 @@ def create_rs256_device(
     # device_id = 'your-device-id'
     # certificate_file = 'path/to/certificate.pem'
 
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
 
     parent = client.registry_path(project_id, cloud_region, registry_id)
 
@@ -142,7 +192,7 @@ def create_es256_device(
     # device_id = 'your-device-id'
     # public_key_file = 'path/to/certificate.pem'
 
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
 
     parent = client.registry_path(project_id, cloud_region, registry_id)
 
@@ -169,27 +219,18 @@ def create_es256_device(
 def create_device(
     service_account_json, project_id, cloud_region, registry_id, device_id
 ):
-    """Create a device to bind to a gateway if it does not exist."""
+    """Create a device to bind to a gateway if it does not exist. Returns
+    the created device, or None if it already existed."""
     # [START iot_create_device]
     # project_id = 'YOUR_PROJECT_ID'
     # cloud_region = 'us-central1'
     # registry_id = 'your-registry-id'
     # device_id = 'your-device-id'
 
-    # Check that the device doesn't already exist
-    client = iot_v1.DeviceManagerClient()
-
-    exists = False
+    client = get_device_manager(service_account_json, cloud_region)
 
     parent = client.registry_path(project_id, cloud_region, registry_id)
 
-    devices = list(client.list_devices(request={"parent": parent}))
-
-    for device in devices:
-        if device.id == device_id:
-            exists = True
-
-    # Create the device
     device_template = {
         "id": device_id,
         "gateway_config": {
@@ -198,13 +239,16 @@ def create_device(
         },
     }
 
-    if not exists:
+    # Create the device; the registry tells if the ID is already taken.
+    try:
         res = client.create_device(
             request={"parent": parent, "device": device_template}
         )
-        print("Created Device {}".format(res))
-    else:
+    except AlreadyExists:
         print("Device exists, skipping")
+        return None
+    print("Created Device {}".format(res))
+    return res
     # [END iot_create_device]
 
 
@@ -217,7 +261,7 @@ def create_unauth_device(
     # cloud_region = 'us-central1'
     # registry_id = 'your-registry-id'
     # device_id = 'your-device-id'
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
 
     parent = client.registry_path(project_id, cloud_region, registry_id)
 
@@ -239,7 +283,7 @@ def delete_device(
     # registry_id = 'your-registry-id'
     # device_id = 'your-device-id'
     print("Delete device")
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
 
     device_path = client.device_path(project_id, cloud_region, registry_id, device_id)
 
@@ -255,7 +299,7 @@ def delete_registry(service_account_json, project_id, cloud_region, registry_id)
     # registry_id = 'your-registry-id'
     print("Delete registry")
 
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
     registry_path = client.registry_path(project_id, cloud_region, registry_id)
 
     try:
@@ -276,7 +320,7 @@ def get_device(service_account_json, project_id, cloud_region, registry_id, devi
     # registry_id = 'your-registry-id'
     # device_id = 'your-device-id'
     print("Getting device")
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
     device_path = client.device_path(project_id, cloud_region, registry_id, device_id)
 
     # See full list of device fields: https://cloud.google.com/iot/docs/reference/cloudiot/rest/v1/projects.locations.registries.devices
@@ -343,7 +387,7 @@ def get_state(service_account_json, project_id, cloud_region, registry_id, devic
     # cloud_region = 'us-central1'
     # registry_id = 'your-registry-id'
     # device_id = 'your-device-id'
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
     device_path = client.device_path(project_id, cloud_region, registry_id, device_id)
 
     device = client.get_device(request={"name": device_path})
@@ -358,49 +402,97 @@ def get_state(service_account_json, project_id, cloud_region, registry_id, devic
     # [END iot_get_device_state]
 
 
+# Field masks of iter_devices(), see the device fields:
+# https://cloud.google.com/iot/docs/reference/cloudiot/rest/v1/projects.locations.registries.devices
+# Warning! Use snake_case field names.
+DEVICE_PROJECTIONS = {
+    # Enough to find devices
+    "ids": ["id", "num_id"],
+    # Connectivity and errors, without credentials, config or state blobs
+    "health": [
+        "id",
+        "name",
+        "num_id",
+        "last_heartbeat_time",
+        "last_event_time",
+        "last_state_time",
+        "last_config_ack_time",
+        "last_config_send_time",
+        "blocked",
+        "last_error_time",
+        "last_error_status",
+        "gateway_config",
+    ],
+    "full": [
+        "id",
+        "name",
+        "num_id",
+        "credentials",
+        "last_heartbeat_time",
+        "last_event_time",
+        "last_state_time",
+        "last_config_ack_time",
+        "last_config_send_time",
+        "blocked",
+        "last_error_time",
+        "last_error_status",
+        "config",
+        "state",
+        "log_level",
+        "metadata",
+        "gateway_config",
+    ],
+}
+
+
+def iter_devices(
+    service_account_json,
+    project_id,
+    cloud_region,
+    registry_id,
+    projection="health",
+    page_size=None,
+    gateway_type=None,
+    gateway_id=None,
+):
+    """Yields the devices of the registry with the fields of a projection
+    of DEVICE_PROJECTIONS, or of a list of field paths. Pages of page_size devices (server default if
+    None) are fetched as the iteration reaches them, so a registry of any
+    size takes the memory of one page. gateway_type (an iot_v1.GatewayType)
+    or gateway_id, the gateway devices are bound to, filter the devices."""
+    client = get_device_manager(service_account_json, cloud_region)
+    registry_path = client.registry_path(project_id, cloud_region, registry_id)
+
+    request = {
+        "parent": registry_path,
+        "field_mask": gp_field_mask.FieldMask(
+            paths=DEVICE_PROJECTIONS[projection] if isinstance(projection, str) else projection
+        ),
+    }
+    if page_size:
+        request["page_size"] = page_size
+    if gateway_type is not None:
+        request["gateway_list_options"] = {"gateway_type": gateway_type}
+    elif gateway_id is not None:
+        request["gateway_list_options"] = {"associations_gateway_id": gateway_id}
+
+    yield from client.list_devices(request=request)
+
+
 def list_devices(service_account_json, project_id, cloud_region, registry_id):
     """List all devices in the registry."""
     # [START iot_list_devices]
     # project_id = 'YOUR_PROJECT_ID'
     # cloud_region = 'us-central1'
     # registry_id = 'your-registry-id'
-    #print("Listing devices")
-
-    client = iot_v1.DeviceManagerClient()
-    registry_path = client.registry_path(project_id, cloud_region, registry_id)
-
-    # See full list of device fields: https://cloud.google.com/iot/docs/reference/cloudiot/rest/v1/projects.locations.registries.devices
-    # Warning! Use snake_case field names.
-    field_mask = gp_field_mask.FieldMask(
-        paths=[
-            "id",
-            "name",
-            "num_id",
-            "credentials",
-            "last_heartbeat_time",
-            "last_event_time",
-            "last_state_time",
-            "last_config_ack_time",
-            "last_config_send_time",
-            "blocked",
-            "last_error_time",
-            "last_error_status",
-            "config",
-            "state",
-            "log_level",
-            "metadata",
-            "gateway_config",
-        ]
-    )
 
-    devices = list(
-        client.list_devices(request={"parent": registry_path, "field_mask": field_mask})
+    # Every field of every device, in memory at once: prefer iter_devices()
+    # for large registries.
+    return list(
+        iter_devices(
+            service_account_json, project_id, cloud_region, registry_id, projection="full"
+        )
     )
-    for device in devices:
-        #print(device)
-        pass
-
-    return devices
     # [END iot_list_devices]
 
 
@@ -410,7 +502,7 @@ def list_registries(service_account_json, project_id, cloud_region):
     # project_id = 'YOUR_PROJECT_ID'
     # cloud_region = 'us-central1'
     print("Listing Registries")
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
     parent = f"projects/{project_id}/locations/{cloud_region}"
 
     registries = list(client.list_device_registries(request={"parent": parent}))
@@ -431,7 +523,7 @@ def create_registry(
     # cloud_region = 'us-central1'
     # pubsub_topic = 'your-pubsub-topic'
     # registry_id = 'your-registry-id'
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
     parent = f"projects/{project_id}/locations/{cloud_region}"
 
     if not pubsub_topic.startswith("projects/"):
@@ -469,7 +561,7 @@ def create_registry_v2(
     # registry_id = 'your-registry-id'
     # event_notification_configs = 'pubsub_subfolder_list'
 
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
     parent = f"projects/{project_id}/locations/{cloud_region}"
 
     if not pubsub_topic.startswith("projects/"):
@@ -504,7 +596,7 @@ def get_registry(service_account_json, project_id, cloud_region, registry_id):
     # project_id = 'YOUR_PROJECT_ID'
     # cloud_region = 'us-central1'
     # registry_id = 'your-registry-id'
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
     registry_path = client.registry_path(project_id, cloud_region, registry_id)
 
     return client.get_device_registry(request={"name": registry_path})
@@ -553,7 +645,7 @@ def patch_es256_auth(
     # public_key_file = 'path/to/certificate.pem'
     print("Patch device with ES256 certificate")
 
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
     device_path = client.device_path(project_id, cloud_region, registry_id, device_id)
 
     public_key_bytes = ""
@@ -595,7 +687,7 @@ def patch_rsa256_auth(
     # public_key_file = 'path/to/certificate.pem'
     print("Patch device with RSA256 certificate")
 
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
     device_path = client.device_path(project_id, cloud_region, registry_id, device_id)
 
     public_key_bytes = ""
@@ -638,7 +730,7 @@ def set_config(
     # version = '0'
     # config= 'your-config-data'
     print("Set device configuration")
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
     device_path = client.device_path(project_id, cloud_region, registry_id, device_id)
 
     data = config.encode("utf-8")
@@ -658,7 +750,7 @@ def get_config_versions(
     # cloud_region = 'us-central1'
     # registry_id = 'your-registry-id'
     # device_id = 'your-device-id'
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
     device_path = client.device_path(project_id, cloud_region, registry_id, device_id)
 
     configs = client.list_device_config_versions(request={"name": device_path})
@@ -680,7 +772,7 @@ def get_iam_permissions(service_account_json, project_id, cloud_region, registry
     # project_id = 'YOUR_PROJECT_ID'
     # cloud_region = 'us-central1'
     # registry_id = 'your-registry-id'
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
 
     registry_path = client.registry_path(project_id, cloud_region, registry_id)
 
@@ -700,7 +792,7 @@ def set_iam_permissions(
     # registry_id = 'your-registry-id'
     # role = 'viewer'
     # member = 'group:dpebot@google.com'
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
     registry_path = client.registry_path(project_id, cloud_region, registry_id)
 
     body = {"bindings": [{"members": [member], "role": role}]}
@@ -715,7 +807,7 @@ def send_command(
     """Send a command to a device."""
     # [START iot_send_command]
     print("Sending command to device")
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
     device_path = client.device_path(project_id, cloud_region, registry_id, device_id)
 
     # command = 'Hello IoT Core!'
@@ -737,7 +829,8 @@ def create_gateway(
     certificate_file,
     algorithm,
 ):
-    """Create a gateway to bind devices to."""
+    """Create a gateway to bind devices to if it does not exist. Returns
+    the created gateway, or None if it already existed."""
     # [START iot_create_gateway]
     # project_id = 'YOUR_PROJECT_ID'
     # cloud_region = 'us-central1'
@@ -746,21 +839,9 @@ def create_gateway(
     # gateway_id = 'your-gateway-id'
     # certificate_file = 'path/to/certificate.pem'
     # algorithm = 'ES256'
-    # Check that the gateway doesn't already exist
-    exists = False
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
 
     parent = client.registry_path(project_id, cloud_region, registry_id)
-    devices = list(client.list_devices(request={"parent": parent}))
-
-    for device in devices:
-        if device.id == gateway_id:
-            exists = True
-        print(
-            "Device: {} : {} : {} : {}".format(
-                device.id, device.num_id, device.config, device.gateway_config
-            )
-        )
 
     with io.open(certificate_file) as f:
         certificate = f.read()
@@ -782,13 +863,16 @@ def create_gateway(
         },
     }
 
-    if not exists:
+    # Create the gateway; the registry tells if the ID is already taken.
+    try:
         res = client.create_device(
             request={"parent": parent, "device": device_template}
         )
-        print("Created Gateway {}".format(res))
-    else:
+    except AlreadyExists:
         print("Gateway exists, skipping")
+        return None
+    print("Created Gateway {}".format(res))
+    return res
     # [END iot_create_gateway]
 
 
@@ -802,7 +886,7 @@ def bind_device_to_gateway(
     # registry_id = 'your-registry-id'
     # device_id = 'your-device-id'
     # gateway_id = 'your-gateway-id'
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
 
     create_device(
         service_account_json, project_id, cloud_region, registry_id, device_id
@@ -828,7 +912,7 @@ def unbind_device_from_gateway(
     # registry_id = 'your-registry-id'
     # device_id = 'your-device-id'
     # gateway_id = 'your-gateway-id'
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
 
     parent = client.registry_path(project_id, cloud_region, registry_id)
 
@@ -846,7 +930,7 @@ def list_gateways(service_account_json, project_id, cloud_region, registry_id):
     # project_id = 'YOUR_PROJECT_ID'
     # cloud_region = 'us-central1'
     # registry_id = 'your-registry-id'
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
 
     path = client.registry_path(project_id, cloud_region, registry_id)
     mask = gp_field_mask.FieldMask()
@@ -870,7 +954,7 @@ def list_devices_for_gateway(
     # cloud_region = 'us-central1'
     # registry_id = 'your-registry-id'
     # gateway_id = 'your-gateway-id'
-    client = iot_v1.DeviceManagerClient()
+    client = get_device_manager(service_account_json, cloud_region)
 
     path = client.registry_path(project_id, cloud_region, registry_id)
 
@@ -898,6 +982,211 @@ def list_devices_for_gateway(
     # [END iot_list_devices_for_gateway]
 
 
+def refresh_mirror(
+    mirror, service_account_json, project_id, cloud_region, registry_id, page_size=None
+):
+    """Lists the registry into a registry_mirror.RegistryMirror: its devices
+    with the health projection and the devices bound to each gateway. Every
+    refresh lists the whole registry and the bindings of each gateway again,
+    as the API cannot list only the devices that changed: what it saves is
+    the writes of the unchanged devices and the config fetches. The config
+    version is fetched with a get_device masked to config.version, so no
+    config blob is downloaded, and only for new devices and those whose
+    last_config_send_time changed: every device on the first refresh of the
+    registry, one RPC each. Returns the number of devices written and
+    removed."""
+    client = get_device_manager(service_account_json, cloud_region)
+    registry = registry_mirror.registry_name(project_id, cloud_region, registry_id)
+    config_mask = gp_field_mask.FieldMask(paths=["config.version"])
+    devices = iter_devices(
+        service_account_json, project_id, cloud_region, registry_id, "health", page_size
+    )
+
+    def config_version(device_id):
+        device_path = client.device_path(project_id, cloud_region, registry_id, device_id)
+        device = client.get_device(request={"name": device_path, "field_mask": config_mask})
+        return device.config.version
+
+    written, removed = mirror.update_devices(registry, devices, config_version)
+    bindings = {}
+    for gateway in mirror.gateways(registry):
+        bindings[gateway["id"]] = [
+            device.id
+            for device in iter_devices(
+                service_account_json,
+                project_id,
+                cloud_region,
+                registry_id,
+                "ids",
+                page_size,
+                gateway_id=gateway["id"],
+            )
+        ]
+    mirror.update_bindings(registry, bindings)
+    mirror.mark_refreshed(registry)
+    return written, removed
+
+
+def mirrored_registry(
+    mirror, service_account_json, project_id, cloud_region, registry_id, max_age, page_size=None
+):
+    """Name of the registry in the mirror, refreshed first if it is older
+    than max_age seconds."""
+    registry = registry_mirror.registry_name(project_id, cloud_region, registry_id)
+    if not mirror.is_fresh(registry, max_age):
+        refresh_mirror(
+            mirror, service_account_json, project_id, cloud_region, registry_id, page_size
+        )
+    return registry
+
+
+class RateLimiter:
+    """Token bucket shared by the provisioning threads: rate requests per
+    second on average, at most burst at once."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Errors of a request that was not carried out and can be sent again.
+RETRIED_ERRORS = (ResourceExhausted, ServiceUnavailable)
+
+
+def call_with_retries(limiter, retries, method, request):
+    """Calls a DeviceManagerClient method once the limiter allows it, and
+    again with exponential backoff and full jitter while the quota is
+    exhausted, up to retries times."""
+    delay = 0.5
+    for attempt in range(retries + 1):
+        limiter.acquire()
+        try:
+            return method(request=request)
+        except RETRIED_ERRORS:
+            if attempt == retries:
+                raise
+            time.sleep(random.uniform(0, delay))
+            delay = min(2 * delay, 30)
+
+
+def load_manifest(manifest_file, gateway_id=None):
+    """Reads a device manifest, a JSON object such as
+
+        {"gateway_id": "flood-control-gw",
+         "devices": ["canal-cleaner", {"device_id": "pump", "gateway_id": "other-gw"}]}
+
+    and returns its (device_id, gateway_id) pairs. Devices without a gateway
+    get the manifest one, else gateway_id."""
+    with io.open(manifest_file) as f:
+        manifest = json.load(f)
+    default_gateway = manifest.get("gateway_id", gateway_id)
+    devices = []
+    for device in manifest["devices"]:
+        if isinstance(device, str):
+            devices.append((device, default_gateway))
+        else:
+            devices.append((device["device_id"], device.get("gateway_id", default_gateway)))
+    return devices
+
+
+def provision_device(client, parent, device_id, gateway_id, limiter, retries):
+    """Creates a device unless it exists and binds it to gateway_id, if any.
+    Returns its result: created is False when the device already existed,
+    bound is None without gateway, error holds the failure if any."""
+    result = {"device_id": device_id, "gateway_id": gateway_id,
+              "created": None, "bound": None, "error": None}
+    device_template = {
+        "id": device_id,
+        "gateway_config": {
+            "gateway_type": iot_v1.GatewayType.NON_GATEWAY,
+            "gateway_auth_method": iot_v1.GatewayAuthMethod.ASSOCIATION_ONLY,
+        },
+    }
+    try:
+        try:
+            call_with_retries(limiter, retries, client.create_device,
+                              {"parent": parent, "device": device_template})
+            result["created"] = True
+        except AlreadyExists:
+            result["created"] = False
+        if gateway_id:
+            try:
+                call_with_retries(limiter, retries, client.bind_device_to_gateway,
+                                  {"parent": parent, "gateway_id": gateway_id, "device_id": device_id})
+            except AlreadyExists:
+                pass
+            result["bound"] = True
+    except GoogleAPICallError as e:
+        result["error"] = "{}: {}".format(type(e).__name__, e.message)
+    except Exception as e:
+        # RetryError, transport errors...: this device failed, not the run.
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+    return result
+
+
+def bulk_provision(
+    service_account_json,
+    project_id,
+    cloud_region,
+    registry_id,
+    devices,
+    max_workers=16,
+    requests_per_second=100,
+    retries=6,
+):
+    """Creates devices and binds them to their gateway, concurrently.
+
+    devices are (device_id, gateway_id) pairs, gateway_id None to only
+    create the device. Existing devices and bindings are left as they are,
+    so a manifest can be run again after a failure. The requests of all the
+    threads are limited to requests_per_second, to stay under the device
+    manager quota of the project, and retried while the quota is exhausted.
+    Returns the result of each device, in order, see provision_device()."""
+    client = get_device_manager(service_account_json, cloud_region)
+    parent = client.registry_path(project_id, cloud_region, registry_id)
+    limiter = RateLimiter(requests_per_second)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(provision_device, client, parent, device_id, gateway_id, limiter, retries)
+                   for device_id, gateway_id in devices]
+        return [future.result() for future in futures]
+
+
+def print_provision_report(results):
+    """Prints one line per device and a summary. Returns the number of
+    devices that failed."""
+    failed = 0
+    for result in results:
+        if result["error"]:
+            failed += 1
+            status = "FAILED {}".format(result["error"])
+        else:
+            status = "created" if result["created"] else "exists"
+            if result["bound"]:
+                status += ", bound to {}".format(result["gateway_id"])
+        print("{}: {}".format(result["device_id"], status))
+    created = sum(1 for result in results if result["created"])
+    existing = sum(1 for result in results if result["created"] is False)
+    print("{} devices: {} created, {} already existed, {} failed".format(
+        len(results), created, existing, failed))
+    return failed
+
+
 def parse_command_line_args():
     """Parse command line arguments."""
     default_registry = "cloudiot_device_manager_example_registry_{}".format(
@@ -933,11 +1222,44 @@ def parse_command_line_args():
         "--ec_public_key_file", default=None, help="Path to public ES256 key file."
     )
     parser.add_argument("--gateway_id", help="Gateway identifier.")
+    parser.add_argument(
+        "--manifest", default=None, help="JSON device manifest for bulk-provision."
+    )
+    parser.add_argument(
+        "--max_workers",
+        default=16,
+        type=int,
+        help="Concurrent requests of bulk-provision.",
+    )
     parser.add_argument("--member", default=None, help="Member used for IAM commands.")
+    parser.add_argument(
+        "--max_age",
+        default=300,
+        type=float,
+        help="Seconds the --mirror answers list commands before it is refreshed.",
+    )
+    parser.add_argument(
+        "--mirror",
+        default=None,
+        help="SQLite registry mirror the list commands answer from. It keeps the"
+        " health fields and the config version, not the full projection.",
+    )
     parser.add_argument("--role", default=None, help="Role used for IAM commands.")
     parser.add_argument(
         "--send_command", default="1", help="The command sent to the device"
     )
+    parser.add_argument(
+        "--page_size",
+        default=None,
+        type=int,
+        help="Devices per page of the list command, the server default if not set.",
+    )
+    parser.add_argument(
+        "--projection",
+        choices=tuple(DEVICE_PROJECTIONS),
+        default="ids",
+        help="Device fields shown by the list command.",
+    )
     parser.add_argument(
         "--project_id",
         default=os.environ.get("GOOGLE_CLOUD_PROJECT"),
@@ -948,6 +1270,12 @@ def parse_command_line_args():
         default=default_registry,
         help="Registry id. If not set, a name will be generated.",
     )
+    parser.add_argument(
+        "--requests_per_second",
+        default=100,
+        type=float,
+        help="Device manager requests per second of bulk-provision, under the project quota.",
+    )
     parser.add_argument(
         "--rsa_certificate_file", default=None, help="Path to RS256 certificate file."
     )
@@ -967,6 +1295,7 @@ def parse_command_line_args():
     command = parser.add_subparsers(dest="command")
 
     command.add_parser("bind-device-to-gateway", help=bind_device_to_gateway.__doc__)
+    command.add_parser("bulk-provision", help=bulk_provision.__doc__)
     command.add_parser("create-es256", help=create_es256_device.__doc__)
     command.add_parser("create-gateway", help=create_gateway.__doc__)
     command.add_parser("create-registry", help=open_registry.__doc__)
@@ -980,7 +1309,7 @@ def parse_command_line_args():
     command.add_parser("get-iam-permissions", help=get_iam_permissions.__doc__)
     command.add_parser("get-registry", help=get_registry.__doc__)
     command.add_parser("get-state", help=get_state.__doc__)
-    command.add_parser("list", help=list_devices.__doc__)
+    command.add_parser("list", help=iter_devices.__doc__)
     command.add_parser(
         "list-devices-for-gateway", help=list_devices_for_gateway.__doc__
     )
@@ -988,6 +1317,7 @@ def parse_command_line_args():
     command.add_parser("list-registries", help=list_registries.__doc__)
     command.add_parser("patch-es256", help=patch_es256_auth.__doc__)
     command.add_parser("patch-rs256", help=patch_rsa256_auth.__doc__)
+    command.add_parser("refresh-mirror", help=refresh_mirror.__doc__)
     command.add_parser("send-command", help=send_command.__doc__)
     command.add_parser("set-config", help=patch_rsa256_auth.__doc__)
     command.add_parser("set-iam-permissions", help=set_iam_permissions.__doc__)
@@ -1107,14 +1437,49 @@ def run_get(args):
         )
 
 
-def run_list(args):
-    if args.command == "list":
-        list_devices(
+def run_list_mirrored(args):
+    """Answers the list commands of a registry from the --mirror. It keeps
+    the health fields and the config version, so list prints the IDs with
+    --projection ids and the mirrored fields with health."""
+    if args.command == "list" and args.projection == "full":
+        sys.exit("Error: --mirror does not keep the full projection, use ids or health")
+    mirror = registry_mirror.RegistryMirror(args.mirror)
+    try:
+        registry = mirrored_registry(
+            mirror,
             args.service_account_json,
             args.project_id,
             args.cloud_region,
             args.registry_id,
+            args.max_age,
+            args.page_size,
         )
+        if args.command == "list":
+            for device in mirror.devices(registry):
+                print(device["id"] if args.projection == "ids" else dict(device))
+        elif args.command == "list-devices-for-gateway":
+            for device_id in mirror.bound_devices(registry, args.gateway_id):
+                print(device_id)
+        elif args.command == "list-gateways":
+            for gateway in mirror.gateways(registry):
+                print("Gateway ID: {}\n\t{}".format(gateway["id"], dict(gateway)))
+    finally:
+        mirror.close()
+
+
+def run_list(args):
+    if args.mirror and args.command != "list-registries":
+        run_list_mirrored(args)
+    elif args.command == "list":
+        for device in iter_devices(
+            args.service_account_json,
+            args.project_id,
+            args.cloud_region,
+            args.registry_id,
+            args.projection,
+            args.page_size,
+        ):
+            print(device.id if args.projection == "ids" else device)
     elif args.command == "list-devices-for-gateway":
         list_devices_for_gateway(
             args.service_account_json,
@@ -1155,6 +1520,20 @@ def run_command(args):
             args.device_id,
             args.gateway_id,
         )
+    elif args.command == "bulk-provision":
+        if args.manifest is None:
+            sys.exit("Error: specify --manifest")
+        results = bulk_provision(
+            args.service_account_json,
+            args.project_id,
+            args.cloud_region,
+            args.registry_id,
+            load_manifest(args.manifest, args.gateway_id),
+            args.max_workers,
+            args.requests_per_second,
+        )
+        if print_provision_report(results):
+            sys.exit(1)
     elif args.command == "delete-device":
         delete_device(
             args.service_account_json,
@@ -1192,6 +1571,22 @@ def run_command(args):
             args.device_id,
             args.rsa_certificate_file,
         )
+    elif args.command == "refresh-mirror":
+        if args.mirror is None:
+            sys.exit("Error: specify --mirror")
+        mirror = registry_mirror.RegistryMirror(args.mirror)
+        try:
+            written, removed = refresh_mirror(
+                mirror,
+                args.service_account_json,
+                args.project_id,
+                args.cloud_region,
+                args.registry_id,
+                args.page_size,
+            )
+        finally:
+            mirror.close()
+        print("{} devices updated, {} removed".format(written, removed))
     elif args.command == "send-command":
         send_command(
             args.service_account_json,
@@ -1241,4 +1636,7 @@ def run_command(args):
 
 if __name__ == "__main__":
     args = parse_command_line_args()
-    run_command(args)
+    try:
+        run_command(args)
+    finally:
+        close_clients()
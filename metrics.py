@@ -0,0 +1,101 @@
+"""
+Minimal Prometheus text format endpoint for the gateway.
+
+The gateway keeps its statistics in plain counters on the objects that own
+them (serial readers, in-flight window, supervisor...). Nothing is recorded
+here: on every scrape the collect callback reads those counters and writes
+them out with a MetricsWriter, so the gateway loop pays nothing for it.
+"""
+
+import http.server
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels.items()) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsWriter:
+    """Builds an exposition in the Prometheus text format."""
+
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, kind, help_text, samples):
+        """Writes a counter or gauge. samples is a value, or an iterable of
+        (labels, value)."""
+        self.lines.append('# HELP {} {}'.format(name, help_text))
+        self.lines.append('# TYPE {} {}'.format(name, kind))
+        if isinstance(samples, (int, float)):
+            samples = [({}, samples)]
+        for labels, value in samples:
+            self.lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+
+    def counter(self, name, help_text, samples):
+        self.metric(name, 'counter', help_text, samples)
+
+    def gauge(self, name, help_text, samples):
+        self.metric(name, 'gauge', help_text, samples)
+
+    def histogram(self, name, help_text, buckets, counts, total):
+        """Writes a histogram from the upper bounds of its buckets, the
+        number of observations in each bucket and the sum of all of them."""
+        self.lines.append('# HELP {} {}'.format(name, help_text))
+        self.lines.append('# TYPE {} histogram'.format(name))
+        cumulative = 0
+        for bound, count in zip(buckets, counts):
+            cumulative += count
+            self.lines.append('{}_bucket{{le="{}"}} {}'.format(name, format_value(bound), cumulative))
+        self.lines.append('{}_sum {}'.format(name, format_value(total)))
+        self.lines.append('{}_count {}'.format(name, cumulative))
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+class MetricsServer:
+    """Serves collect(writer) on GET /metrics from a daemon thread."""
+
+    def __init__(self, port, collect, host='127.0.0.1'):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                writer = MetricsWriter()
+                collect(writer)
+                body = writer.text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,212 @@
+"""
+Telemetry payload encoders.
+
+Every encoder turns a reading (the event dict built by SensorSchema) or a
+batch of readings into a message payload:
+
+- JsonEncoder: json.dumps, the historical format.
+- JsonTemplateEncoder: the same JSON text, written from a format string
+  built once per sensor layout instead of walking the dict.
+- CborEncoder: CBOR (RFC 8949), starting with the self-describe tag
+  0xD9D9F7 so that it can be told apart from the other encodings.
+- ProtobufEncoder: the messages of telemetry.proto. A payload is always a
+  <Sensor>Readings message, also for a single reading.
+
+Readings that do not have the layout an encoder was built for, such as the
+summaries of the edge aggregation, are encoded as JSON.
+"""
+
+import json
+import math
+import struct
+
+CBOR_SELF_DESCRIBE = b'\xd9\xd9\xf7'
+
+
+class JsonEncoder:
+    name = 'json'
+
+    def encode(self, reading):
+        return json.dumps(reading)
+
+    def encode_batch(self, readings):
+        return json.dumps(readings)
+
+
+class JsonTemplateEncoder(JsonEncoder):
+    """json.dumps output for readings of one layout: device_id, the fields
+    in order, then timestamp."""
+
+    name = 'json_template'
+
+    def __init__(self, fields, timestamp_type):
+        keys = ['device_id'] + [name for name, _ in fields] + ['timestamp']
+        types = [str] + [field_type for _, field_type in fields] + [timestamp_type]
+        self.keys = tuple(keys)
+        self.strings = tuple(i for i, field_type in enumerate(types) if field_type is str)
+        self.floats = tuple(key for key, field_type in zip(keys, types) if field_type is float)
+        self.template = '{{' + ', '.join('{}: {{}}'.format(json.dumps(key)) for key in keys) + '}}'
+        # JSON text of the device IDs, as each reading repeats its own
+        self.quoted = {}
+
+    def encode(self, reading):
+        if len(reading) != len(self.keys):
+            return json.dumps(reading)
+        for key in self.floats:
+            if not math.isfinite(reading[key]):
+                # Written NaN and Infinity by json.dumps
+                return json.dumps(reading)
+        values = [reading[key] for key in self.keys]
+        for i in self.strings:
+            value = values[i]
+            if i == 0:
+                quoted = self.quoted.get(value)
+                if quoted is None:
+                    quoted = self.quoted[value] = json.dumps(value)
+                values[0] = quoted
+            else:
+                values[i] = json.dumps(value)
+        return self.template.format(*values)
+
+    def encode_batch(self, readings):
+        return '[' + ', '.join(map(self.encode, readings)) + ']'
+
+
+def _cbor_head(major, value):
+    if value < 24:
+        return bytes((major << 5 | value,))
+    if value < 0x100:
+        return struct.pack('>BB', major << 5 | 24, value)
+    if value < 0x10000:
+        return struct.pack('>BH', major << 5 | 25, value)
+    if value < 0x100000000:
+        return struct.pack('>BI', major << 5 | 26, value)
+    return struct.pack('>BQ', major << 5 | 27, value)
+
+
+def cbor_encode(value, out):
+    """Append the CBOR encoding of a JSON-like value to the bytearray out."""
+    if value is True:
+        out.append(0xf5)
+    elif value is False:
+        out.append(0xf4)
+    elif value is None:
+        out.append(0xf6)
+    elif isinstance(value, int):
+        out += _cbor_head(0, value) if value >= 0 else _cbor_head(1, -1 - value)
+    elif isinstance(value, float):
+        out += struct.pack('>Bd', 0xfb, value)
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        out += _cbor_head(3, len(data))
+        out += data
+    elif isinstance(value, (bytes, bytearray)):
+        out += _cbor_head(2, len(value))
+        out += value
+    elif isinstance(value, dict):
+        out += _cbor_head(5, len(value))
+        for key, item in value.items():
+            cbor_encode(key, out)
+            cbor_encode(item, out)
+    elif isinstance(value, (list, tuple)):
+        out += _cbor_head(4, len(value))
+        for item in value:
+            cbor_encode(item, out)
+    else:
+        raise TypeError('cannot encode {!r} in CBOR'.format(value))
+
+
+class CborEncoder:
+    name = 'cbor'
+
+    def encode(self, reading):
+        out = bytearray(CBOR_SELF_DESCRIBE)
+        cbor_encode(reading, out)
+        return bytes(out)
+
+    encode_batch = encode
+
+
+def _varint(value):
+    if value < 0:
+        # int32 and int64 fields: negative values take ten bytes.
+        value += 1 << 64
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+class ProtobufEncoder:
+    """Readings of one layout as telemetry.proto messages.
+
+    Field numbers follow the layout: device_id is 1, the sensor fields are
+    2, 3, ... in order, then the timestamp, as a string (RFC 3339) or, one
+    number further, as an int64 (epoch ms). int fields are int32, float
+    fields double, str fields string.
+    """
+
+    name = 'protobuf'
+
+    WIRE_TYPES = {int: 0, float: 1, str: 2}
+
+    def __init__(self, fields, timestamp_type):
+        self.fallback = JsonEncoder()
+        layout = [('device_id', str)] + list(fields)
+        numbers = list(range(1, len(layout) + 1))
+        # The RFC 3339 and epoch ms timestamps have their own numbers.
+        layout.append(('timestamp', timestamp_type))
+        numbers.append(len(layout) if timestamp_type is str else len(layout) + 1)
+        # (name, type, field key: number << 3 | wire type)
+        self.fields = tuple((name, field_type, _varint(number << 3 | self.WIRE_TYPES[field_type]))
+                            for (name, field_type), number in zip(layout, numbers))
+
+    def encode_reading(self, reading):
+        out = bytearray()
+        for name, field_type, key in self.fields:
+            value = reading[name]
+            out += key
+            if field_type is str:
+                data = value.encode('utf-8')
+                out += _varint(len(data))
+                out += data
+            elif field_type is float:
+                out += struct.pack('<d', value)
+            else:
+                out += _varint(value)
+        return out
+
+    def encode(self, reading):
+        return self.encode_batch((reading,))
+
+    def encode_batch(self, readings):
+        if any(len(reading) != len(self.fields) for reading in readings):
+            return self.fallback.encode_batch(readings)
+        out = bytearray()
+        for reading in readings:
+            message = self.encode_reading(reading)
+            # <Sensor>Readings.readings, field 1, length delimited
+            out.append(0x0a)
+            out += _varint(len(message))
+            out += message
+        return bytes(out)
+
+
+ENCODERS = {
+    'json': lambda fields, timestamp_type: JsonEncoder(),
+    'json_template': JsonTemplateEncoder,
+    'cbor': lambda fields, timestamp_type: CborEncoder(),
+    'protobuf': ProtobufEncoder,
+}
+
+
+def create_encoder(name, fields, timestamp_type):
+    """Encoder `name` for readings with the given (name, type) fields and a
+    timestamp of timestamp_type (str or int)."""
+    try:
+        factory = ENCODERS[name]
+    except KeyError:
+        raise ValueError('unknown payload encoding {!r}, expected one of {}'.format(name, ', '.join(ENCODERS)))
+    return factory(fields, timestamp_type)
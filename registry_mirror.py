@@ -0,0 +1,188 @@
+"""
+Local SQLite mirror of Cloud IoT Core registries.
+
+Keeps the devices of each registry, with their connectivity times, error and
+config version, and the gateway bindings, so that status and list commands
+can answer without listing the registry again. manager.refresh_mirror() fills
+it; a refresh still lists the whole registry, but only writes the devices
+whose mirrored fields changed since the previous one and removes those that
+are gone. The config version is not in the listing: it is only fetched for
+new devices and those whose last_config_send_time moved. Each registry
+records when it was refreshed, for readers to decide whether it is still
+fresh enough.
+"""
+
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS registries (
+    name TEXT PRIMARY KEY,
+    refreshed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS devices (
+    registry TEXT NOT NULL,
+    id TEXT NOT NULL,
+    num_id INTEGER,
+    name TEXT,
+    gateway_type INTEGER,
+    gateway_auth_method INTEGER,
+    blocked INTEGER,
+    last_heartbeat_time TEXT,
+    last_event_time TEXT,
+    last_state_time TEXT,
+    last_config_ack_time TEXT,
+    last_config_send_time TEXT,
+    last_error_time TEXT,
+    last_error_message TEXT,
+    config_version INTEGER,
+    PRIMARY KEY (registry, id)
+);
+CREATE TABLE IF NOT EXISTS bindings (
+    registry TEXT NOT NULL,
+    gateway_id TEXT NOT NULL,
+    device_id TEXT NOT NULL,
+    PRIMARY KEY (registry, gateway_id, device_id)
+);
+"""
+
+# Columns of devices after registry, in the order of device_row().
+DEVICE_COLUMNS = (
+    "id",
+    "num_id",
+    "name",
+    "gateway_type",
+    "gateway_auth_method",
+    "blocked",
+    "last_heartbeat_time",
+    "last_event_time",
+    "last_state_time",
+    "last_config_ack_time",
+    "last_config_send_time",
+    "last_error_time",
+    "last_error_message",
+    "config_version",
+)
+
+# iot_v1.GatewayType.GATEWAY
+GATEWAY = 1
+
+LAST_CONFIG_SEND_TIME = DEVICE_COLUMNS.index("last_config_send_time")
+CONFIG_VERSION = DEVICE_COLUMNS.index("config_version")
+
+
+def registry_name(project_id, cloud_region, registry_id):
+    return "projects/{}/locations/{}/registries/{}".format(project_id, cloud_region, registry_id)
+
+
+def format_time(value):
+    """RFC 3339 text of a device timestamp, None when it was never set."""
+    return None if value is None else value.isoformat()
+
+
+def device_row(device, config_version):
+    """Mirrored fields of an iot_v1.Device, as a tuple of DEVICE_COLUMNS."""
+    return (
+        device.id,
+        device.num_id,
+        device.name,
+        int(device.gateway_config.gateway_type),
+        int(device.gateway_config.gateway_auth_method),
+        int(device.blocked),
+        format_time(device.last_heartbeat_time),
+        format_time(device.last_event_time),
+        format_time(device.last_state_time),
+        format_time(device.last_config_ack_time),
+        format_time(device.last_config_send_time),
+        format_time(device.last_error_time),
+        device.last_error_status.message,
+        config_version,
+    )
+
+
+class RegistryMirror:
+    """Registries mirrored in the SQLite database at path. Registries are
+    identified by their full name, projects/.../registries/<id>."""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def age(self, registry):
+        """Seconds since the registry was last refreshed, None if never."""
+        row = self.connection.execute(
+            "SELECT refreshed_at FROM registries WHERE name = ?", (registry,)).fetchone()
+        return None if row is None else time.time() - row["refreshed_at"]
+
+    def is_fresh(self, registry, max_age):
+        age = self.age(registry)
+        return age is not None and age <= max_age
+
+    def update_devices(self, registry, devices, config_version):
+        """Brings the devices of the registry up to date with devices, every
+        iot_v1.Device it has, listed without config. config_version(device_id)
+        returns the config version of a device; it is only called for new
+        devices and those whose last_config_send_time changed, the others
+        keep the mirrored one. Only devices whose mirrored fields changed are
+        written. Returns the number of devices written and removed."""
+        known = {row[0]: tuple(row)
+                 for row in self.connection.execute(
+                     "SELECT {} FROM devices WHERE registry = ?".format(", ".join(DEVICE_COLUMNS)), (registry,))}
+        written = 0
+        with self.connection:
+            for device in devices:
+                previous = known.pop(device.id, None)
+                if (previous is not None
+                        and previous[LAST_CONFIG_SEND_TIME] == format_time(device.last_config_send_time)):
+                    version = previous[CONFIG_VERSION]
+                else:
+                    version = config_version(device.id)
+                row = device_row(device, version)
+                if previous != row:
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO devices (registry, {}) VALUES (?{})".format(
+                            ", ".join(DEVICE_COLUMNS), ", ?" * len(DEVICE_COLUMNS)),
+                        (registry,) + row)
+                    written += 1
+            # What is left was not listed: deleted from the registry.
+            self.connection.executemany(
+                "DELETE FROM devices WHERE registry = ? AND id = ?", ((registry, id_) for id_ in known))
+        return written, len(known)
+
+    def update_bindings(self, registry, bindings):
+        """Replaces the bindings of the registry with bindings, the device
+        IDs bound to each gateway ID."""
+        with self.connection:
+            self.connection.execute("DELETE FROM bindings WHERE registry = ?", (registry,))
+            self.connection.executemany(
+                "INSERT INTO bindings (registry, gateway_id, device_id) VALUES (?, ?, ?)",
+                ((registry, gateway_id, device_id)
+                 for gateway_id, device_ids in bindings.items() for device_id in device_ids))
+
+    def mark_refreshed(self, registry):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO registries (name, refreshed_at) VALUES (?, ?)", (registry, time.time()))
+
+    def devices(self, registry, gateway_type=None):
+        """Mirrored devices of the registry, by ID, optionally only those of
+        a gateway_type (an iot_v1.GatewayType)."""
+        query = "SELECT * FROM devices WHERE registry = ?"
+        params = [registry]
+        if gateway_type is not None:
+            query += " AND gateway_type = ?"
+            params.append(int(gateway_type))
+        return self.connection.execute(query + " ORDER BY id", params).fetchall()
+
+    def gateways(self, registry):
+        return self.devices(registry, GATEWAY)
+
+    def bound_devices(self, registry, gateway_id):
+        """IDs of the devices bound to gateway_id."""
+        return [row[0] for row in self.connection.execute(
+            "SELECT device_id FROM bindings WHERE registry = ? AND gateway_id = ? ORDER BY device_id",
+            (registry, gateway_id))]
@@ -0,0 +1,138 @@
+"""
+Compact binary framing for the Arduino serial link, an alternative to the
+ASCII "#id,v1,v2" lines for firmware that supports it.
+
+Frame layout:
+
+    0xA5 | length | type | payload (length bytes) | CRC16 (big endian)
+
+The CRC is CRC-16/CCITT-FALSE over length, type and payload. Payload fields
+are packed little endian with a fixed width per frame type, see
+FRAME_FORMATS. Frames sent to the Arduino, CONFIG and COMMAND, carry the
+sensor node ID followed by a free-form payload, see encode_message.
+"""
+
+import struct
+
+SYNC = 0xA5
+HEADER_SIZE = 3
+CRC_SIZE = 2
+
+# Frame types. Reading types are the sensor node ID of the ASCII protocol.
+CANAL_CLEANER = 0x01
+WEATHER_STATION = 0x02
+ATTACH = 0x10
+DETACH = 0x11
+SUBSCRIBE = 0x12
+# Gateway to Arduino
+CONFIG = 0x20
+COMMAND = 0x21
+MAX_PAYLOAD = 255
+
+# Frame type -> (payload layout, divisor applied to each field)
+FRAME_FORMATS = {
+    # obstruction
+    CANAL_CLEANER: (struct.Struct('<B'), (1,)),
+    # humidity x10, temperature x10, water level
+    WEATHER_STATION: (struct.Struct('<hhB'), (10, 10, 1)),
+    # sensor node ID
+    ATTACH: (struct.Struct('<B'), (1,)),
+    DETACH: (struct.Struct('<B'), (1,)),
+    SUBSCRIBE: (struct.Struct('<B'), (1,)),
+}
+
+
+def _crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return table
+
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16(data, crc=0xFFFF):
+    """CRC-16/CCITT-FALSE of data."""
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+
+def encode_frame(frame_type, *values):
+    """Pack values into a complete frame, as the Arduino firmware does."""
+    layout, scales = FRAME_FORMATS[frame_type]
+    payload = layout.pack(*(round(value * scale) for value, scale in zip(values, scales)))
+    body = bytes((len(payload), frame_type)) + payload
+    return bytes((SYNC,)) + body + crc16(body).to_bytes(CRC_SIZE, 'big')
+
+
+def encode_message(frame_type, node_id, payload):
+    """Frame a CONFIG or COMMAND payload (bytes) for sensor node node_id."""
+    body = bytes((node_id,)) + payload
+    if len(body) > MAX_PAYLOAD:
+        raise ValueError('payload of {} bytes does not fit in a frame'.format(len(payload)))
+    body = bytes((len(body), frame_type)) + body
+    return bytes((SYNC,)) + body + crc16(body).to_bytes(CRC_SIZE, 'big')
+
+
+def decode_frame(frame):
+    """Unpack a frame returned by BinaryFramer into (type, values)."""
+    frame_type = frame[0]
+    layout, scales = FRAME_FORMATS[frame_type]
+    values = layout.unpack_from(frame, 1)
+    return frame_type, tuple(value / scale if scale != 1 else value
+                             for value, scale in zip(values, scales))
+
+
+class BinaryFramer:
+    """Streaming decoder for binary frames.
+
+    feed() returns each valid frame as bytes (type followed by payload).
+    Bytes that do not start a frame are skipped, and a frame with an unknown
+    type, a wrong length or a bad CRC is dropped by resuming the search one
+    byte after its sync byte.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.dropped_frames = 0
+        self.skipped_bytes = 0
+
+    def feed(self, data):
+        buf = self.buffer
+        buf += data
+        frames = []
+        size = len(buf)
+        pos = 0
+        while True:
+            start = buf.find(SYNC, pos)
+            if start < 0:
+                self.skipped_bytes += size - pos
+                pos = size
+                break
+            self.skipped_bytes += start - pos
+            if size - start < HEADER_SIZE:
+                pos = start
+                break
+            length = buf[start + 1]
+            frame_format = FRAME_FORMATS.get(buf[start + 2])
+            if frame_format is None or frame_format[0].size != length:
+                self.dropped_frames += 1
+                pos = start + 1
+                continue
+            end = start + HEADER_SIZE + length + CRC_SIZE
+            if end > size:
+                pos = start
+                break
+            if crc16(buf[start + 1:end - CRC_SIZE]) != int.from_bytes(buf[end - CRC_SIZE:end], 'big'):
+                self.dropped_frames += 1
+                pos = start + 1
+                continue
+            frames.append(bytes(buf[start + 2:end - CRC_SIZE]))
+            pos = end
+        del buf[:pos]
+        return frames
@@ -0,0 +1,87 @@
+"""
+Disk-backed store-and-forward queue for the gateway telemetry.
+
+Every message is appended to a SQLite database in WAL mode before it is
+published, and deleted only once the broker side acknowledged it. After a
+crash or a long disconnection the uploader resumes from the oldest message
+that was not acknowledged, so delivery is at-least-once and in order.
+"""
+
+import sqlite3
+import time
+
+
+class ReadingQueue:
+    """Append-only queue of (topic, payload) messages.
+
+    The queue holds at most max_messages; when it is full the oldest
+    messages are dropped and counted in `dropped`. Acknowledged messages are
+    deleted in batches by commit_acks(), and the database file is shrunk
+    every compact_every deletions.
+    """
+
+    def __init__(self, path, max_messages, compact_every=1000):
+        self.max_messages = max_messages
+        self.compact_every = compact_every
+        self.db = sqlite3.connect(path, isolation_level=None)
+        # auto_vacuum has to be chosen before the first table is created.
+        self.db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS messages ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' topic TEXT NOT NULL,'
+            ' payload BLOB NOT NULL,'
+            ' created REAL NOT NULL)')
+        self.size = self.db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+        self.acked = []
+        self.deleted_since_compact = 0
+        self.appended = 0
+        self.dropped = 0
+
+    def append(self, topic, payload):
+        self.db.execute('INSERT INTO messages (topic, payload, created) VALUES (?, ?, ?)',
+                        (topic, payload, time.time()))
+        self.size += 1
+        self.appended += 1
+        if self.size > self.max_messages:
+            excess = self.size - self.max_messages
+            self.db.execute('DELETE FROM messages WHERE id IN '
+                            '(SELECT id FROM messages ORDER BY id LIMIT ?)', (excess,))
+            self.size -= excess
+            self.dropped += excess
+            self.deleted_since_compact += excess
+
+    def peek(self, limit, after_id=0):
+        """Returns up to limit (id, topic, payload) messages with an id
+        greater than after_id, oldest first."""
+        return self.db.execute('SELECT id, topic, payload FROM messages WHERE id > ? ORDER BY id LIMIT ?',
+                               (after_id, limit)).fetchall()
+
+    def ack(self, message_id):
+        """Marks a message as delivered. It is deleted on the next
+        commit_acks()."""
+        self.acked.append((message_id,))
+
+    def commit_acks(self):
+        if not self.acked:
+            return
+        with self.db:
+            self.db.execute('BEGIN')
+            cursor = self.db.executemany('DELETE FROM messages WHERE id = ?', self.acked)
+        self.size -= cursor.rowcount
+        self.deleted_since_compact += cursor.rowcount
+        self.acked = []
+        if self.deleted_since_compact >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        """Give the pages of deleted messages back to the file system."""
+        self.db.execute('PRAGMA incremental_vacuum')
+        self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.deleted_since_compact = 0
+
+    def close(self):
+        self.commit_acks()
+        self.db.close()
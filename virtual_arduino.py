@@ -0,0 +1,163 @@
+"""
+Virtual Arduino speaking the gateway serial protocol over a pseudo-terminal,
+used to benchmark the gateway serial path without hardware.
+
+Usage example, from the directory of config.json, which the background
+reader benchmark loads through gateway:
+
+    python virtual_arduino.py --rate 2000 --seconds 5
+"""
+
+import argparse
+import os
+import random
+import threading
+import time
+
+import serial
+
+
+class VirtualArduino:
+    """A pty pair: the gateway opens `port`, we write to the master side."""
+
+    def __init__(self):
+        self.master, self.slave = os.openpty()
+        self.port = os.ttyname(self.slave)
+        self.sent = {}
+
+    def write_line(self, line):
+        os.write(self.master, line.encode() + b'\n')
+
+    def send_readings(self, count, rate):
+        """Send count weather station readings at rate lines per second.
+        The humidity field carries the sequence number so the receiver can
+        match each frame to its send time."""
+        interval = 1.0 / rate
+        next_send = time.perf_counter()
+        for seq in range(count):
+            self.sent[seq] = time.perf_counter()
+            self.write_line('#2,{},21.5,1'.format(seq))
+            next_send += interval
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    def attach(self, nodes=('1', '2')):
+        for node in nodes:
+            self.write_line('#attach,{}'.format(node))
+
+    def detach(self, nodes=('1', '2')):
+        for node in nodes:
+            self.write_line('#detach,{}'.format(node))
+
+    def send_stream(self, rate, seconds, jitter=0.0, first_seq=0, nodes=('1', '2')):
+        """Send readings of the nodes in turn for seconds, rate lines per
+        second on average. Each interval is randomly stretched or shrunk by
+        up to the jitter fraction. The first field of each reading (the
+        obstruction of node 1, the humidity of node 2) carries the sequence
+        number. Returns the next sequence number."""
+        interval = 1.0 / rate
+        next_send = time.perf_counter()
+        end_seq = first_seq + int(rate * seconds)
+        for seq in range(first_seq, end_seq):
+            node = nodes[seq % len(nodes)]
+            self.sent[seq] = time.perf_counter()
+            self.write_line(reading_line(node, seq))
+            next_send += interval * (1 + random.uniform(-jitter, jitter))
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        return end_seq
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def reading_line(node, seq):
+    if node == '1':
+        return '#1,{}'.format(seq)
+    return '#2,{},21.5,1'.format(seq)
+
+
+class BusyPoll:
+    """The gateway serial loop before the background reader, kept as the
+    benchmark baseline. Each get() is one turn of it: a 10 ms sleep, then a
+    readline() that blocks up to the serial timeout (0.1 s, as the gateway
+    opened the port), None if that turn read nothing."""
+
+    def __init__(self, ser):
+        self.ser = ser
+
+    def get(self):
+        time.sleep(0.01)
+        return self.ser.readline() or None
+
+    def close(self):
+        pass
+
+
+class BackgroundReader:
+    def __init__(self, ser):
+        # gateway reads config.json from the current directory on import.
+        import gateway
+        self.reader = gateway.start_serial_reader(ser.port, lambda port: ser)
+
+    def get(self):
+        return self.reader.get(timeout=0.1)
+
+    def close(self):
+        self.reader.stop()
+        print('\toverruns : {}, dropped frames : {}, read errors : {}'.format(
+            self.reader.overruns, self.reader.dropped_frames, self.reader.read_errors))
+
+
+def run_benchmark(name, rate, seconds, receiver_class):
+    arduino = VirtualArduino()
+    ser = serial.Serial(arduino.port, 9600, timeout=0.1)
+    count = int(rate * seconds)
+    sender = threading.Thread(target=arduino.send_readings, args=(count, rate), daemon=True)
+
+    latencies = []
+    receiver = receiver_class(ser)
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    sender.start()
+    deadline = wall_start + seconds + 2
+    while len(latencies) < count and time.perf_counter() < deadline:
+        frame = receiver.get()
+        if frame is None:
+            continue
+        seq = int(float(frame.split(b',')[1]))
+        latencies.append(time.perf_counter() - arduino.sent[seq])
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    sender.join()
+
+    latencies.sort()
+    received = len(latencies)
+    print('{}:'.format(name))
+    print('\treceived : {}/{} frames in {:.2f} s ({:.0f} frames/s)'.format(
+        received, count, wall, received / wall))
+    print('\tcpu : {:.2f} s ({:.0f}% of one core)'.format(cpu, 100 * cpu / wall))
+    if latencies:
+        print('\tlatency p50/p99 : {:.2f} / {:.2f} ms'.format(
+            1000 * latencies[received // 2], 1000 * latencies[int(received * 0.99)]))
+    receiver.close()
+    ser.close()
+    arduino.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=float, default=500, help='Readings per second.')
+    parser.add_argument('--seconds', type=float, default=5, help='Benchmark duration.')
+    args = parser.parse_args()
+
+    run_benchmark('busy poll', args.rate, args.seconds, BusyPoll)
+    run_benchmark('background reader', args.rate, args.seconds, BackgroundReader)
+
+
+if __name__ == '__main__':
+    main()